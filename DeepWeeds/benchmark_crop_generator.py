@@ -0,0 +1,63 @@
+import argparse
+from time import time
+import numpy as np
+from deepweeds import crop, crop_generator, RAW_IMG_SIZE, IMG_SIZE, BATCH_SIZE
+
+
+def legacy_crop_generator(batches, size):
+    """
+    The original crop generator, which copies each image into a fresh float64 batch.
+    :param batches: Batches of images to be cropped
+    :param size: Size to be cropped to
+    :return:
+    """
+    while True:
+        batch_x, batch_y = next(batches)
+        (b, h, w, c) = batch_x.shape
+        batch_crops = np.zeros((b, size[0], size[1], c))
+        for i in range(b):
+            batch_crops[i] = crop(batch_x[i], (size[0], size[1]))
+        yield (batch_crops, batch_y)
+
+
+def random_batches(batch_size):
+    """
+    Endlessly yield the same random float32 batch, standing in for a Keras ImageGen.
+    :param batch_size: Number of images per batch
+    :return:
+    """
+    batch_x = np.random.rand(batch_size, RAW_IMG_SIZE[0], RAW_IMG_SIZE[1], 3).astype(np.float32)
+    batch_y = np.zeros((batch_size, 9), dtype=np.float32)
+    while True:
+        yield (batch_x, batch_y)
+
+
+def time_generator(generator, steps):
+    """
+    Time pulling batches from a generator, touching every pixel of each batch.
+    :param generator: Generator to time
+    :param steps: Number of batches to pull
+    :return: Mean time per batch (ms)
+    """
+    next(generator)
+    start_time = time()
+    for _ in range(steps):
+        batch_crops, _ = next(generator)
+        np.ascontiguousarray(batch_crops).sum()
+    return (time() - start_time) * 1000 / steps
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and vectorized DeepWeeds crop generators.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="Number of images per batch.")
+    parser.add_argument('--steps', type=int, default=100, help="Number of batches to time per generator.")
+    args = parser.parse_args()
+
+    generators = [
+        ("legacy", legacy_crop_generator(random_batches(args.batch_size), IMG_SIZE)),
+        ("view", crop_generator(random_batches(args.batch_size), IMG_SIZE)),
+        ("view, random crop", crop_generator(random_batches(args.batch_size), IMG_SIZE, random_crop=True)),
+        ("ring buffer", crop_generator(random_batches(args.batch_size), IMG_SIZE, ring_size=12)),
+    ]
+    for name, generator in generators:
+        print("{:<20s} {:8.2f} ms/batch".format(name, time_generator(generator, args.steps)))
@@ -0,0 +1,154 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import downloader
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves one archive with HTTP Range support, standing in for Google Drive. The server's faults are set on the
+    class: truncated responses, HTML quota pages and corrupt archives.
+    """
+    archive = b""
+    truncations = 0
+    html_pages = 0
+    corrupt = False
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        try:
+            self.respond()
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients may hang up without reading the body, e.g. when probing Google Drive for its confirm token
+            pass
+
+    def respond(self):
+        if StandInHandler.html_pages > 0:
+            StandInHandler.html_pages -= 1
+            body = b"<html>Quota exceeded</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        data = StandInHandler.archive
+        if StandInHandler.corrupt:
+            # Flip bytes inside the first member, so the zip directory is intact but its CRC fails
+            data = data[:100] + bytes(b ^ 0xFF for b in data[100:110]) + data[110:]
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].split("-")[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(len(data)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if StandInHandler.truncations > 0:
+            # Close the connection a third of the way through the body
+            StandInHandler.truncations -= 1
+            self.wfile.write(body[:len(body) // 3])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def make_archive(members=20, member_size=50000):
+    """
+    Build a zip archive of random members.
+    :param members: Number of members
+    :param member_size: Size of each member in bytes
+    :return: Archive bytes
+    """
+    random = np.random.RandomState(0)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_ref:
+        for i in range(members):
+            zip_ref.writestr("archive/member{}.bin".format(i), random.bytes(member_size))
+    return buffer.getvalue()
+
+
+def check(directory):
+    """
+    Run the download layer against a local stand-in server and check resume, verification and eviction.
+    :param directory: Empty scratch directory
+    :return:
+    """
+    StandInHandler.archive = make_archive()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/archive.zip".format(server.server_port)
+    downloader.GOOGLE_DRIVE_URL = url
+    cache = os.path.join(directory, "cache/")
+
+    # An interrupted download is resumed with a Range request and completes
+    StandInHandler.truncations = 1
+    path = downloader.fetch(url, "resumed", cache_directory=cache)
+    with open(path, "rb") as f:
+        assert f.read() == StandInHandler.archive, "resumed download differs from the archive"
+    digest = os.path.basename(path)
+    print("resume: ok")
+
+    # A cached download is served without touching the server
+    assert downloader.cached("resumed", cache_directory=cache) == path
+    print("cache hit: ok")
+
+    # An HTML page is never cached
+    StandInHandler.html_pages = 1
+    try:
+        downloader.fetch(url, "html", cache_directory=cache)
+        raise AssertionError("HTML page was accepted")
+    except IOError:
+        assert "html" not in downloader.read_refs(cache)
+    print("HTML page rejected: ok")
+
+    # A download that does not match its expected digest is discarded
+    try:
+        downloader.fetch(url, "mismatch", sha256="0" * 64, cache_directory=cache)
+        raise AssertionError("checksum mismatch was accepted")
+    except IOError:
+        assert "mismatch" not in downloader.read_refs(cache)
+        assert not os.path.exists(os.path.join(cache, "mismatch.part"))
+    print("checksum mismatch: ok")
+
+    # A corrupt archive is evicted when extraction fails, and the next run downloads and extracts it cleanly
+    StandInHandler.corrupt = True
+    extract_directory = os.path.join(directory, "extracted/")
+    try:
+        downloader.fetch_and_extract_google_drive_file("archive", extract_directory, cache_directory=cache)
+        raise AssertionError("corrupt archive was extracted")
+    except zipfile.BadZipFile:
+        assert "archive" not in downloader.read_refs(cache), "corrupt archive is still referenced"
+    StandInHandler.corrupt = False
+    pin_file = os.path.join(directory, "checksums.json")
+    downloader.fetch_and_extract_google_drive_file("archive", extract_directory, cache_directory=cache,
+                                                   pin_file=pin_file)
+    assert len(os.listdir(os.path.join(extract_directory, "archive"))) == 20
+    assert downloader.read_pins(pin_file)["archive"] == digest, "extracted archive was not pinned"
+    print("eviction and pinning: ok")
+
+    server.shutdown()
+    print("All download checks passed.")
+
+
+if __name__ == '__main__':
+    scratch = tempfile.mkdtemp()
+    try:
+        check(scratch)
+    finally:
+        shutil.rmtree(scratch)
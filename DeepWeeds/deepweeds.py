@@ -1,13 +1,12 @@
 import argparse
 import os
-from zipfile import ZipFile
 from urllib.request import urlopen
 import shutil
 import pandas as pd
 from time import time
 from datetime import datetime
-from keras.preprocessing.image import ImageDataGenerator
-from keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau, TensorBoard, CSVLogger
+from keras.preprocessing.image import ImageDataGenerator, Iterator, load_img, img_to_array
+from keras.callbacks import Callback, ModelCheckpoint, EarlyStopping, ReduceLROnPlateau, TensorBoard, CSVLogger
 from keras.optimizers import Adam
 import csv
 from keras.models import Model, load_model
@@ -19,17 +18,27 @@ from skimage.transform import resize
 from keras.applications.inception_v3 import InceptionV3
 from keras.applications.resnet50 import ResNet50
 from keras.layers import Dense, GlobalAveragePooling2D
-import requests
+from downloader import fetch_and_extract_google_drive_file
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+import ast
+import json
+import tensorflow as tf
 
 # Global paths
 OUTPUT_DIRECTORY = "./outputs/"
 LABEL_DIRECTORY = "./weed-gan/labels/"
 MODEL_DIRECTORY = "./models/"
 MODEL_GD_ID = "1MRbN5hXOTYnw7-71K-2vjY01uJ9GkQM5"
-MODEL_ZIP_FILE = "./models/models.zip"
 IMG_DIRECTORY = "./images/"
 IMG_GD_ID = "1xnK3B6K6KekDI55vwJ0vnc2IGoDga9cj"
-IMG_ZIP_FILE = "./images/images.zip"
+# Expected SHA-256 digests of the archives. By default they are read from CHECKSUM_FILE, which pins each archive the
+# first time it is downloaded and extracted in full, and the environment variables override them
+CHECKSUM_FILE = "./checksums.json"
+IMG_SHA256 = os.environ.get("DEEPWEEDS_IMG_SHA256")
+MODEL_SHA256 = os.environ.get("DEEPWEEDS_MODEL_SHA256")
+IMG_CACHE_FILE = "./images/images.npy"
+FOLD_INDEX_FILE = LABEL_DIRECTORY + "fold_index.npz"
 
 # Global variables
 RAW_IMG_SIZE = (256, 256)
@@ -38,6 +47,7 @@ INPUT_SHAPE = (IMG_SIZE[0], IMG_SIZE[1], 3)
 MAX_EPOCH = 5
 BATCH_SIZE = 64
 FOLDS = 5
+FOLD_ROLES = ['train', 'val', 'test']
 STOPPING_PATIENCE = 32
 LR_PATIENCE = 16
 INITIAL_LR = 0.0001
@@ -54,68 +64,175 @@ CLASS_NAMES = ['Chinee Apple',
                'Negatives']
 
 
-def download_google_drive_file(id, destination):
-    URL = "https://docs.google.com/uc?export=download"
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train and test ResNet50, InceptionV3, or custom model on DeepWeeds.')
+    parser.add_argument("command", default='train', help="'cross_validate', 'inference', 'benchmark' or 'build_cache'")
+    parser.add_argument('--model', default='resnet', help="'resnet', 'inception', or path to .hdf5 file.")
+    parser.add_argument('--batch-size', type=int, default=1, help="Number of images per inference batch.")
+    parser.add_argument('--decode-workers', type=int, default=1, help="Number of threads decoding images for inference.")
+    parser.add_argument('--use-cache', action='store_true', help="Read images from the cache written by 'build_cache'.")
+    parser.add_argument('--fold-workers', type=int, default=1, help="Number of folds to cross validate concurrently.")
+    parser.add_argument('--threads-per-worker', type=int, default=None, help="Number of threads used by each fold worker.")
+    parser.add_argument('--training-mode', default='default', choices=['default', 'fast'],
+                        help="'fast' applies the OpenMP settings recommended for MKL builds of TensorFlow.")
+    parser.add_argument('--batch-sizes', default='1,8,32', help="Comma separated batch sizes to benchmark.")
+    parser.add_argument('--thread-counts', default='1,4', help="Comma separated intra-op thread counts to benchmark.")
+    parser.add_argument('--images', type=int, default=256, help="Number of images to benchmark over.")
+    parser.add_argument('--warmup', type=int, default=3, help="Number of warm-up batches excluded from the benchmark.")
+    args = parser.parse_args()
+    return args
 
-    session = requests.Session()
 
-    response = session.get(URL, params = { 'id' : id }, stream = True)
-    token = get_confirm_token(response)
+def download_images():
+    # Fetch the archive into the download cache (resuming if interrupted), then extract it if not already done
+    print("Fetching DeepWeeds images")
+    fetch_and_extract_google_drive_file(IMG_GD_ID, IMG_DIRECTORY, IMG_SHA256, pin_file=CHECKSUM_FILE)
+    print("DeepWeeds images are in " + IMG_DIRECTORY)
 
-    if token:
-        params = { 'id' : id, 'confirm' : token }
-        response = session.get(URL, params = params, stream = True)
 
-    save_response_content(response, destination)
+def download_models():
+    # Fetch the archive into the download cache (resuming if interrupted), then extract it if not already done
+    print("Fetching DeepWeeds models")
+    fetch_and_extract_google_drive_file(MODEL_GD_ID, MODEL_DIRECTORY, MODEL_SHA256, pin_file=CHECKSUM_FILE)
+    print("DeepWeeds models are in " + MODEL_DIRECTORY)
 
 
-def get_confirm_token(response):
-    for key, value in response.cookies.items():
-        if key.startswith('download_warning'):
-            return value
+def build_image_cache(decode_workers=1):
+    """
+    Decode every image in labels.csv once, resized to RAW_IMG_SIZE, into a uint8 .npy file
+    whose rows follow the order of labels.csv.
+    :param decode_workers: Number of threads decoding images
+    :return:
+    """
+    filenames = list(pd.read_csv(LABEL_DIRECTORY + "labels.csv").Filename)
+    print("Caching {} DeepWeeds images to {}".format(len(filenames), IMG_CACHE_FILE))
+    images = np.lib.format.open_memmap(IMG_CACHE_FILE + ".tmp", mode='w+', dtype=np.uint8,
+                                       shape=(len(filenames), RAW_IMG_SIZE[0], RAW_IMG_SIZE[1], 3))
 
-    return None
+    # Decode the same way as flow_from_dataframe so that cached and uncached training see identical inputs
+    def decode(filename):
+        return img_to_array(load_img(IMG_DIRECTORY + filename, target_size=RAW_IMG_SIZE), dtype=np.uint8)
 
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor:
+        for i, img in enumerate(executor.map(decode, filenames)):
+            images[i] = img
+    images.flush()
+    del images
+    os.replace(IMG_CACHE_FILE + ".tmp", IMG_CACHE_FILE)
+    print("Finished caching images.")
 
-def save_response_content(response, destination):
-    CHUNK_SIZE = 32768
 
-    with open(destination, "wb") as f:
-        for chunk in response.iter_content(CHUNK_SIZE):
-            if chunk: # filter out keep-alive new chunks
-                f.write(chunk)
+def load_image_cache():
+    """
+    Open the image cache written by build_image_cache without reading it into memory.
+    :return: Memory-mapped images and a dictionary from filename to row
+    """
+    images = np.load(IMG_CACHE_FILE, mmap_mode='r')
+    filenames = pd.read_csv(LABEL_DIRECTORY + "labels.csv").Filename
+    index = {filename: row for row, filename in enumerate(filenames)}
+    assert len(index) == images.shape[0], "Image cache is out of date, rebuild it with 'build_cache'."
+    return images, index
 
 
-def parse_args():
-    parser = argparse.ArgumentParser(description='Train and test ResNet50, InceptionV3, or custom model on DeepWeeds.')
-    parser.add_argument("command", default='train', help="'cross_validate' or 'inference'")
-    parser.add_argument('--model', default='resnet', help="'resnet', 'inception', or path to .hdf5 file.")
-    args = parser.parse_args()
-    return args.command, args.model
+def build_fold_index():
+    """
+    Encode labels.csv and the train, validation and test subsets of every fold as integer arrays, saved to
+    FOLD_INDEX_FILE. Rows follow the order of labels.csv, so a row is also the image's row in the image cache.
+    :return: Fold index with 'filenames', 'labels' and 'roles' arrays, where roles[i, k] is the position of image i's
+    subset for fold k in FOLD_ROLES, or -1 if it is in none
+    """
+    labels = pd.read_csv(LABEL_DIRECTORY + "labels.csv")
+    row = {filename: i for i, filename in enumerate(labels.Filename)}
+    roles = np.full((labels.shape[0], FOLDS), -1, dtype=np.int8)
+    classes = labels.Label.values.astype(np.int8)
+    for k in range(FOLDS):
+        for code, role in enumerate(FOLD_ROLES):
+            subset = pd.read_csv("{}{}_subset{}.csv".format(LABEL_DIRECTORY, role, k))
+            subset_rows = [row[filename] for filename in subset.Filename]
+            roles[subset_rows, k] = code
+            # Training has always used the labels of the subset files, which can differ from labels.csv
+            classes[subset_rows] = subset.Label.values
+    fold_index = {'filenames': np.array(labels.Filename.tolist(), dtype=str),
+                  'labels': classes,
+                  'roles': roles}
+    with open(FOLD_INDEX_FILE + ".tmp", 'wb') as f:
+        np.savez(f, **fold_index)
+    os.replace(FOLD_INDEX_FILE + ".tmp", FOLD_INDEX_FILE)
+    return fold_index
+
+
+def load_fold_index():
+    """
+    Load the fold index, building it first if it is missing or older than the label files.
+    :return: Fold index as returned by build_fold_index
+    """
+    label_files = [LABEL_DIRECTORY + "labels.csv"] + ["{}{}_subset{}.csv".format(LABEL_DIRECTORY, role, k)
+                                                       for k in range(FOLDS) for role in FOLD_ROLES]
+    if not os.path.exists(FOLD_INDEX_FILE) or \
+            os.path.getmtime(FOLD_INDEX_FILE) < max(os.path.getmtime(f) for f in label_files):
+        return build_fold_index()
+    with np.load(FOLD_INDEX_FILE) as data:
+        return {key: data[key] for key in data.files}
 
 
-def download_images():
-    if not os.path.exists(IMG_DIRECTORY):
-        os.makedirs(IMG_DIRECTORY)
-        print("Downloading DeepWeeds images to " + IMG_ZIP_FILE)
-        download_google_drive_file(IMG_GD_ID, IMG_ZIP_FILE)
-        print("Finished downloading images.")
-        print("Unzipping " + IMG_ZIP_FILE)
-        with ZipFile(IMG_ZIP_FILE, "r") as zip_ref:
-            zip_ref.extractall(IMG_DIRECTORY)
-        print("Finished unzipping images.")
+def fold_rows(fold_index, k, role):
+    """
+    Get the images in one subset of a fold.
+    :param fold_index: Fold index returned by load_fold_index
+    :param k: Fold number
+    :param role: 'train', 'val' or 'test'
+    :return: Rows of the images, in labels.csv order
+    """
+    return np.flatnonzero(fold_index['roles'][:, k] == FOLD_ROLES.index(role))
 
 
-def download_models():
-    if not os.path.exists(MODEL_DIRECTORY):
-        os.makedirs(MODEL_DIRECTORY)
-        print("Downloading DeepWeeds models to " + MODEL_ZIP_FILE)
-        download_google_drive_file(MODEL_GD_ID, MODEL_ZIP_FILE)
-        print("Finished downloading models.")
-        print("Unzipping " + MODEL_ZIP_FILE)
-        with ZipFile(MODEL_ZIP_FILE, "r") as zip_ref:
-            zip_ref.extractall(MODEL_DIRECTORY)
-        print("Finished unzipping models.")
+def fold_dataframe(fold_index, rows):
+    """
+    Build the dataframe expected by flow_from_dataframe for some rows of the fold index.
+    :param fold_index: Fold index returned by load_fold_index
+    :param rows: Rows of the images
+    :return: Dataframe with Filename and Label columns as strings
+    """
+    return pd.DataFrame({'Filename': fold_index['filenames'][rows],
+                         'Label': fold_index['labels'][rows].astype(str)})
+
+
+class CacheIterator(Iterator):
+    """
+    Drop-in replacement for the iterator returned by flow_from_dataframe that reads
+    images from the memory-mapped cache instead of decoding them from disk.
+    """
+
+    def __init__(self, rows, classes, image_cache, image_data_generator, target_size, batch_size, shuffle=True,
+                 seed=None):
+        images, _ = image_cache
+        self.images = images
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.classes = np.asarray(classes, dtype=np.int64)
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        # Nearest neighbour sampling, as used by flow_from_dataframe, for sizes other than the cached one
+        (h, w) = images.shape[1:3]
+        self.y_samples = ((np.arange(self.target_size[0]) + 0.5) * h / self.target_size[0]).astype(int)
+        self.x_samples = ((np.arange(self.target_size[1]) + 0.5) * w / self.target_size[1]).astype(int)
+        super(CacheIterator, self).__init__(len(self.rows), batch_size, shuffle, seed)
+
+    def _get_batches_of_transformed_samples(self, index_array):
+        rows = self.rows[index_array]
+        # Read the batch from the memmap in file order
+        order = np.argsort(rows)
+        batch_raw = np.empty((len(rows),) + self.images.shape[1:], dtype=np.uint8)
+        batch_raw[order] = self.images[rows[order]]
+        if self.target_size != self.images.shape[1:3]:
+            batch_raw = batch_raw[:, self.y_samples][:, :, self.x_samples]
+        batch_x = np.empty((len(rows),) + self.target_size + (3,), dtype=K.floatx())
+        for i in range(len(rows)):
+            x = batch_raw[i].astype(K.floatx())
+            x = self.image_data_generator.random_transform(x)
+            batch_x[i] = self.image_data_generator.standardize(x)
+        batch_y = np.zeros((len(rows), len(CLASSES)), dtype=K.floatx())
+        batch_y[np.arange(len(rows)), self.classes[index_array]] = 1.
+        return batch_x, batch_y
 
 
 def crop(img, size):
@@ -131,70 +248,173 @@ def crop(img, size):
     return img[y:(y + size[1]), x:(x + size[0]), :]
 
 
-def crop_generator(batches, size):
+def crop_generator(batches, size, random_crop=False, ring_size=None):
     """
-    Take as input a Keras ImageGen (Iterator) and generate random
-    crops from the image batches generated by the original iterator
+    Take as input a Keras ImageGen (Iterator) and generate crops from the
+    image batches generated by the original iterator. The whole batch is
+    cropped with a single slice, at the centre or at a random offset shared
+    by the batch.
     :param batches: Batches of images to be cropped
     :param size: Size to be cropped to
+    :param random_crop: Crop at a random offset instead of concentrically
+    :param ring_size: If None, yield float32 views of the original batches. Otherwise copy the crops into a ring of
+    ring_size preallocated contiguous buffers, which must be larger than the number of batches queued by the consumer
     :return:
     """
+    buffers = None
+    i = 0
     while True:
         batch_x, batch_y = next(batches)
         (b, h, w, c) = batch_x.shape
-        batch_crops = np.zeros((b, size[0], size[1], c))
-        for i in range(b):
-            batch_crops[i] = crop(batch_x[i], (size[0], size[1]))
+        if random_crop:
+            x = np.random.randint(0, w - size[0] + 1)
+            y = np.random.randint(0, h - size[1] + 1)
+        else:
+            x = int((w - size[0]) / 2)
+            y = int((h - size[1]) / 2)
+        batch_crops = batch_x[:, y:(y + size[1]), x:(x + size[0]), :]
+        if ring_size is None:
+            batch_crops = batch_crops.astype(np.float32, copy=False)
+        else:
+            if buffers is None or buffers[0].shape[0] < b:
+                buffers = [np.empty((b, size[1], size[0], c), dtype=np.float32) for _ in range(ring_size)]
+            buffer = buffers[i % ring_size][:b]
+            np.copyto(buffer, batch_crops, casting='unsafe')
+            batch_crops = buffer
+            i = i + 1
         yield (batch_crops, batch_y)
 
 
-def cross_validate(model_name):
+def set_fold_session(threads, config=None):
+    """
+    Give Keras a new TensorFlow session with its thread pools capped. K.clear_session() at the end of train_fold
+    discards the session, so this runs at the start of every fold, in worker processes and serially alike.
+    :param threads: Number of intra-op threads, or None to keep the TensorFlow default
+    :param config: Optional ConfigProto to cap, e.g. with other options already set
+    :return:
+    """
+    if threads is None and config is None:
+        return
+    config = config or tf.ConfigProto()
+    if threads is not None:
+        config.intra_op_parallelism_threads = threads
+    K.set_session(tf.Session(config=config))
+
+
+def configure_session(threads=None, training_mode='default'):
+    """
+    Set up the TensorFlow session used by Keras. Must be called again after K.clear_session().
+    :param threads: Number of intra-op threads, or None for the TensorFlow default
+    :param training_mode: 'default' leaves TensorFlow untouched apart from threads, 'fast' also applies the
+    recommended OpenMP settings for MKL builds of TensorFlow. Stock builds ignore these settings, so 'fast' only
+    speeds up training on MKL builds; the thread pools are left at the TensorFlow defaults either way.
+    :return:
+    """
+    if training_mode == 'fast':
+        is_mkl_enabled = getattr(tf.pywrap_tensorflow, "IsMklEnabled", None)
+        if is_mkl_enabled is not None and not is_mkl_enabled():
+            print("TensorFlow is not an MKL build, --training-mode fast has no effect on training speed.")
+        # Read by the MKL OpenMP runtime when the first session starts its thread pools
+        if threads is not None:
+            os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+        os.environ.setdefault("KMP_BLOCKTIME", "1")
+        os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+    set_fold_session(threads)
+
+
+class ThroughputLogger(Callback):
+    """
+    Add the training throughput of each epoch to the logs, so that CSVLogger records it in training_metrics.csv.
+    Only the training batches are timed: the epoch ends with the validation pass, which runs after the last batch.
+    Must come before CSVLogger in the list of callbacks.
+    """
 
-    # K fold cross validation, saving outputs for each fold
-    for k in range(FOLDS):
+    def __init__(self, images_per_epoch):
+        super(ThroughputLogger, self).__init__()
+        self.images_per_epoch = images_per_epoch
+        self.epoch_start = None
+        self.last_batch_end = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time()
+        self.last_batch_end = None
+
+    def on_batch_end(self, batch, logs=None):
+        self.last_batch_end = time()
 
-        # Create new output directory for individual folds from timestamp
-        timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
-        print('Fold {}/{} - {}'.format(k + 1, FOLDS, timestamp))
-        output_directory = "{}{}/".format(OUTPUT_DIRECTORY, timestamp)
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
-
-        # Prepare training, validation and testing labels for kth fold
-        train_label_file = "{}train_subset{}.csv".format(LABEL_DIRECTORY, k)
-        val_label_file = "{}val_subset{}.csv".format(LABEL_DIRECTORY, k)
-        test_label_file = "{}test_subset{}.csv".format(LABEL_DIRECTORY, k)
-        train_dataframe = pd.read_csv(train_label_file,dtype=str)
-        val_dataframe = pd.read_csv(val_label_file,dtype=str)
-        test_dataframe = pd.read_csv(test_label_file,dtype=str)
-        train_image_count = train_dataframe.shape[0]
-        val_image_count = train_dataframe.shape[0]
-        test_image_count = test_dataframe.shape[0]
-
-        # Training image augmentation
-        train_data_generator = ImageDataGenerator(
-            rescale=1. / 255,
-            fill_mode="constant",
-            shear_range=0.2,
-            zoom_range=(0.5, 1),
-            horizontal_flip=True,
-            rotation_range=360,
-            channel_shift_range=25,
-            brightness_range=(0.75, 1.25))
-
-        # Validation image augmentation
-        val_data_generator = ImageDataGenerator(
-            rescale=1. / 255,
-            fill_mode="constant",
-            shear_range=0.2,
-            zoom_range=(0.5, 1),
-            horizontal_flip=True,
-            rotation_range=360,
-            channel_shift_range=25,
-            brightness_range=(0.75, 1.25))
-
-        # No testing image augmentation (except for converting pixel values to floats)
-        test_data_generator = ImageDataGenerator(rescale=1. / 255)
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None and self.last_batch_end is not None:
+            logs['images_per_sec'] = self.images_per_epoch / (self.last_batch_end - self.epoch_start)
+
+
+def train_fold(model_name, k, image_cache=None, fold_index=None, threads=None, training_mode='default'):
+    """
+    Train and test a model on the kth cross validation fold.
+    :param model_name: 'resnet' or 'inception'
+    :param k: Fold number
+    :param image_cache: Optional image cache returned by load_image_cache
+    :param fold_index: Optional fold index returned by load_fold_index
+    :param threads: Number of intra-op threads, see configure_session
+    :param training_mode: 'default' or 'fast', see configure_session
+    :return: Output directory holding the fold's models and reports
+    """
+    configure_session(threads, training_mode)
+
+    # Create new output directory for individual folds from timestamp and fold number, as folds may start together
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
+    print('Fold {}/{} - {}'.format(k + 1, FOLDS, timestamp))
+    output_directory = "{}{}-fold{}/".format(OUTPUT_DIRECTORY, timestamp, k)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Prepare training, validation and testing labels for kth fold
+    if fold_index is None:
+        fold_index = load_fold_index()
+    train_rows = fold_rows(fold_index, k, 'train')
+    val_rows = fold_rows(fold_index, k, 'val')
+    test_rows = fold_rows(fold_index, k, 'test')
+    train_image_count = len(train_rows)
+    val_image_count = len(train_rows)
+    test_image_count = len(test_rows)
+
+    # Training image augmentation
+    train_data_generator = ImageDataGenerator(
+        rescale=1. / 255,
+        fill_mode="constant",
+        shear_range=0.2,
+        zoom_range=(0.5, 1),
+        horizontal_flip=True,
+        rotation_range=360,
+        channel_shift_range=25,
+        brightness_range=(0.75, 1.25))
+
+    # Validation image augmentation
+    val_data_generator = ImageDataGenerator(
+        rescale=1. / 255,
+        fill_mode="constant",
+        shear_range=0.2,
+        zoom_range=(0.5, 1),
+        horizontal_flip=True,
+        rotation_range=360,
+        channel_shift_range=25,
+        brightness_range=(0.75, 1.25))
+
+    # No testing image augmentation (except for converting pixel values to floats)
+    test_data_generator = ImageDataGenerator(rescale=1. / 255)
+
+    if image_cache is not None:
+        # Read train, validation and test images in batches from the image cache
+        labels = fold_index['labels']
+        train_data_generator = CacheIterator(train_rows, labels[train_rows], image_cache, train_data_generator,
+                                             RAW_IMG_SIZE, BATCH_SIZE)
+        val_data_generator = CacheIterator(val_rows, labels[val_rows], image_cache, val_data_generator,
+                                           RAW_IMG_SIZE, BATCH_SIZE)
+        test_data_generator = CacheIterator(test_rows, labels[test_rows], image_cache, test_data_generator,
+                                            IMG_SIZE, BATCH_SIZE, shuffle=False)
+    else:
+        train_dataframe = fold_dataframe(fold_index, train_rows)
+        val_dataframe = fold_dataframe(fold_index, val_rows)
+        test_dataframe = fold_dataframe(fold_index, test_rows)
 
         # Load train images in batches from directory and apply augmentations
         train_data_generator = train_data_generator.flow_from_dataframe(
@@ -233,97 +453,238 @@ def cross_validate(model_name):
             classes=CLASSES_str,
             class_mode='categorical')
 
-        # Crop augmented images from 256x256 to 224x224
-        train_data_generator = crop_generator(train_data_generator, IMG_SIZE)
-        val_data_generator = crop_generator(val_data_generator, IMG_SIZE)
-
-        # Load ImageNet pre-trained model with no top, either InceptionV3 or ResNet50
-        if model_name == "resnet":
-            base_model = ResNet50(weights='imagenet', include_top=False, input_shape=INPUT_SHAPE)
-        elif model_name == "inception":
-            base_model = InceptionV3(weights='imagenet', include_top=False, input_shape=INPUT_SHAPE)
-        x = base_model.output
-        # Add a global average pooling layer
-        x = GlobalAveragePooling2D(name='avg_pool')(x)
-        # Add fully connected output layer with sigmoid activation for multi label classification
-        outputs = Dense(len(CLASSES), activation='sigmoid', name='fc9')(x)
-        # Assemble the modified model
-        model = Model(inputs=base_model.input, outputs=outputs)
-
-        # Checkpoints for training
-        model_checkpoint = ModelCheckpoint(output_directory + "lastbest-0.hdf5", verbose=1, save_best_only=True)
-        early_stopping = EarlyStopping(patience=STOPPING_PATIENCE, restore_best_weights=True)
-        tensorboard = TensorBoard(log_dir=output_directory, histogram_freq=0, write_graph=True, write_images=False)
-        reduce_lr = ReduceLROnPlateau('val_loss', factor=0.5, patience=LR_PATIENCE, min_lr=0.000003125)
-        model.compile(loss='binary_crossentropy', optimizer=Adam(lr=INITIAL_LR), metrics=['categorical_accuracy'])
-        csv_logger = CSVLogger(output_directory + "training_metrics.csv")
-
-        # Train model until MAX_EPOCH, restarting after each early stop when learning has plateaued
-        global_epoch = 0
-        restarts = 0
-        last_best_losses = []
-        last_best_epochs = []
-        while global_epoch < MAX_EPOCH:
-            history = model.fit_generator(
-                generator=train_data_generator,
-                steps_per_epoch=train_image_count // BATCH_SIZE,
-                epochs=MAX_EPOCH - global_epoch,
-                validation_data=val_data_generator,
-                validation_steps=val_image_count // BATCH_SIZE,
-                callbacks=[tensorboard, model_checkpoint, early_stopping, reduce_lr, csv_logger],
-                shuffle=False)
-            last_best_losses.append(min(history.history['val_loss']))
-            last_best_local_epoch = history.history['val_loss'].index(min(history.history['val_loss']))
-            last_best_epochs.append(global_epoch + last_best_local_epoch)
-            if early_stopping.stopped_epoch == 0:
-                print("Completed training after {} epochs.".format(MAX_EPOCH))
-                break
-            else:
-                global_epoch = global_epoch + early_stopping.stopped_epoch - STOPPING_PATIENCE + 1
-                print("Early stopping triggered after local epoch {} (global epoch {}).".format(
-                    early_stopping.stopped_epoch, global_epoch))
-                print("Restarting from last best val_loss at local epoch {} (global epoch {}).".format(
-                    early_stopping.stopped_epoch - STOPPING_PATIENCE, global_epoch - STOPPING_PATIENCE))
-                restarts = restarts + 1
-                model.compile(loss='binary_crossentropy', optimizer=Adam(lr=INITIAL_LR / 2 ** restarts),
-                              metrics=['categorical_accuracy'])
-                model_checkpoint = ModelCheckpoint(output_directory + "lastbest-{}.hdf5".format(restarts),
-                                                   monitor='val_loss', verbose=1, save_best_only=True, mode='min')
-
-        # Save last best model info
-        with open(output_directory + "last_best_models.csv", 'w', newline='') as file:
-            writer = csv.writer(file, delimiter=',')
-            writer.writerow(['Model file', 'Global epoch', 'Validation loss'])
-            for i in range(restarts + 1):
-                writer.writerow(["lastbest-{}.hdf5".format(i), last_best_epochs[i], last_best_losses[i]])
-
-        # Load the last best model
-        model = load_model(
-            output_directory + "lastbest-{}.hdf5".format(last_best_losses.index(min(last_best_losses))))
-
-        # Evaluate model on test subset for kth fold
-        predictions = model.predict_generator(test_data_generator, test_image_count // BATCH_SIZE + 1)
-        y_true = test_data_generator.classes
-        y_pred = np.argmax(predictions, axis=1)
-        y_pred[np.max(predictions, axis=1) < 1 / 9] = 8  # Assign predictions worse than random guess to negative class
-
-        # Generate and print classification metrics and confusion matrix
-        print(classification_report(y_true, y_pred, labels=CLASSES, target_names=CLASS_NAMES))
-        report = classification_report(y_true, y_pred, labels=CLASSES, target_names=CLASS_NAMES, output_dict=True)
-        with open(output_directory + 'classification_report.csv', 'w') as f:
-            for key in report.keys():
-                f.write("%s,%s\n" % (key, report[key]))
-        conf_arr = confusion_matrix(y_true, y_pred, labels=CLASSES)
-        print(conf_arr)
-        np.savetxt(output_directory + "confusion_matrix.csv", conf_arr, delimiter=",")
-
-        # Clear model from GPU after each iteration
-        print("Finished testing fold {}\n".format(k + 1))
-        K.clear_session()
-        k = k + 1
+    # Crop augmented images from 256x256 to 224x224
+    train_data_generator = crop_generator(train_data_generator, IMG_SIZE)
+    val_data_generator = crop_generator(val_data_generator, IMG_SIZE)
+
+    # Load ImageNet pre-trained model with no top, either InceptionV3 or ResNet50
+    if model_name == "resnet":
+        base_model = ResNet50(weights='imagenet', include_top=False, input_shape=INPUT_SHAPE)
+    elif model_name == "inception":
+        base_model = InceptionV3(weights='imagenet', include_top=False, input_shape=INPUT_SHAPE)
+    x = base_model.output
+    # Add a global average pooling layer
+    x = GlobalAveragePooling2D(name='avg_pool')(x)
+    # Add fully connected output layer with sigmoid activation for multi label classification
+    outputs = Dense(len(CLASSES), activation='sigmoid', name='fc9')(x)
+    # Assemble the modified model
+    model = Model(inputs=base_model.input, outputs=outputs)
+
+    # Checkpoints for training
+    model_checkpoint = ModelCheckpoint(output_directory + "lastbest-0.hdf5", verbose=1, save_best_only=True)
+    early_stopping = EarlyStopping(patience=STOPPING_PATIENCE, restore_best_weights=True)
+    tensorboard = TensorBoard(log_dir=output_directory, histogram_freq=0, write_graph=True, write_images=False)
+    reduce_lr = ReduceLROnPlateau('val_loss', factor=0.5, patience=LR_PATIENCE, min_lr=0.000003125)
+    model.compile(loss='binary_crossentropy', optimizer=Adam(lr=INITIAL_LR), metrics=['categorical_accuracy'])
+    csv_logger = CSVLogger(output_directory + "training_metrics.csv")
+    throughput_logger = ThroughputLogger((train_image_count // BATCH_SIZE) * BATCH_SIZE)
+
+    # Train model until MAX_EPOCH, restarting after each early stop when learning has plateaued
+    global_epoch = 0
+    restarts = 0
+    last_best_losses = []
+    last_best_epochs = []
+    while global_epoch < MAX_EPOCH:
+        history = model.fit_generator(
+            generator=train_data_generator,
+            steps_per_epoch=train_image_count // BATCH_SIZE,
+            epochs=MAX_EPOCH - global_epoch,
+            validation_data=val_data_generator,
+            validation_steps=val_image_count // BATCH_SIZE,
+            callbacks=[tensorboard, model_checkpoint, early_stopping, reduce_lr, throughput_logger, csv_logger],
+            shuffle=False)
+        last_best_losses.append(min(history.history['val_loss']))
+        last_best_local_epoch = history.history['val_loss'].index(min(history.history['val_loss']))
+        last_best_epochs.append(global_epoch + last_best_local_epoch)
+        if early_stopping.stopped_epoch == 0:
+            print("Completed training after {} epochs.".format(MAX_EPOCH))
+            break
+        else:
+            global_epoch = global_epoch + early_stopping.stopped_epoch - STOPPING_PATIENCE + 1
+            print("Early stopping triggered after local epoch {} (global epoch {}).".format(
+                early_stopping.stopped_epoch, global_epoch))
+            print("Restarting from last best val_loss at local epoch {} (global epoch {}).".format(
+                early_stopping.stopped_epoch - STOPPING_PATIENCE, global_epoch - STOPPING_PATIENCE))
+            restarts = restarts + 1
+            model.compile(loss='binary_crossentropy', optimizer=Adam(lr=INITIAL_LR / 2 ** restarts),
+                          metrics=['categorical_accuracy'])
+            model_checkpoint = ModelCheckpoint(output_directory + "lastbest-{}.hdf5".format(restarts),
+                                               monitor='val_loss', verbose=1, save_best_only=True, mode='min')
+
+    # Save last best model info
+    with open(output_directory + "last_best_models.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Model file', 'Global epoch', 'Validation loss'])
+        for i in range(restarts + 1):
+            writer.writerow(["lastbest-{}.hdf5".format(i), last_best_epochs[i], last_best_losses[i]])
+
+    # Load the last best model
+    model = load_model(
+        output_directory + "lastbest-{}.hdf5".format(last_best_losses.index(min(last_best_losses))))
+
+    # Evaluate model on test subset for kth fold
+    predictions = model.predict_generator(test_data_generator, test_image_count // BATCH_SIZE + 1)
+    y_true = test_data_generator.classes
+    y_pred = np.argmax(predictions, axis=1)
+    y_pred[np.max(predictions, axis=1) < 1 / 9] = 8  # Assign predictions worse than random guess to negative class
+
+    # Generate and print classification metrics and confusion matrix
+    print(classification_report(y_true, y_pred, labels=CLASSES, target_names=CLASS_NAMES))
+    report = classification_report(y_true, y_pred, labels=CLASSES, target_names=CLASS_NAMES, output_dict=True)
+    with open(output_directory + 'classification_report.csv', 'w') as f:
+        for key in report.keys():
+            f.write("%s,%s\n" % (key, report[key]))
+    conf_arr = confusion_matrix(y_true, y_pred, labels=CLASSES)
+    print(conf_arr)
+    np.savetxt(output_directory + "confusion_matrix.csv", conf_arr, delimiter=",")
+
+    # Clear model from GPU after each iteration
+    print("Finished testing fold {}\n".format(k + 1))
+    K.clear_session()
+    return output_directory
+
+
+def init_fold_worker(threads):
+    """
+    Cap the number of OpenMP threads used by a fold worker process. TensorFlow's own thread pools are capped by
+    set_fold_session at the start of every fold, as K.clear_session() discards them.
+    :param threads: Number of threads, or None to keep the defaults
+    :return:
+    """
+    if threads is not None:
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+
+
+def run_fold(model_name, k, use_cache, threads, training_mode):
+    """
+    Train and test a single fold inside a fold worker process.
+    :param model_name: 'resnet' or 'inception'
+    :param k: Fold number
+    :param use_cache: Whether to read images from the image cache
+    :param threads: Number of intra-op threads, see configure_session
+    :param training_mode: 'default' or 'fast', see configure_session
+    :return: Output directory holding the fold's models and reports
+    """
+    image_cache = load_image_cache() if use_cache else None
+    return train_fold(model_name, k, image_cache, threads=threads, training_mode=training_mode)
 
 
-def inference(model):
+def read_classification_report(path):
+    """
+    Read a classification_report.csv written by train_fold.
+    :param path: Path to classification_report.csv
+    :return: Dictionary from class name (or average) to its metrics
+    """
+    report = {}
+    with open(path, 'r') as f:
+        for line in f:
+            key, metrics = line.rstrip("\n").split(",", 1)
+            report[key] = ast.literal_eval(metrics)
+    return report
+
+
+def aggregate_folds(fold_directories):
+    """
+    Merge the per fold classification reports and confusion matrices into one cross validation report.
+    :param fold_directories: Output directories of the individual folds
+    :return: Output directory holding the aggregate report
+    """
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
+    output_directory = "{}{}-cross_validation/".format(OUTPUT_DIRECTORY, timestamp)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Aggregate the confusion matrix across the independent folds
+    conf_arr = sum(np.loadtxt(d + "confusion_matrix.csv", delimiter=",") for d in fold_directories)
+    print(conf_arr)
+    np.savetxt(output_directory + "confusion_matrix.csv", conf_arr, delimiter=",")
+
+    # Average the classification metrics across the folds
+    reports = [read_classification_report(d + "classification_report.csv") for d in fold_directories]
+    with open(output_directory + "classification_report.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Class', 'Precision mean', 'Precision std', 'Recall mean', 'Recall std',
+                         'F1-score mean', 'F1-score std', 'Support'])
+        for key in reports[0].keys():
+            row = [key]
+            if not isinstance(reports[0][key], dict):
+                # Overall accuracy is reported as a single number
+                values = [report[key] for report in reports]
+                writer.writerow(row + [np.mean(values), np.std(values)])
+                continue
+            for metric in ['precision', 'recall', 'f1-score']:
+                values = [report[key][metric] for report in reports]
+                row += [np.mean(values), np.std(values)]
+            row.append(sum(report[key]['support'] for report in reports))
+            writer.writerow(row)
+    print("Cross validation report saved to " + output_directory)
+    return output_directory
+
+
+def cross_validate(model_name, image_cache=None, fold_workers=1, threads_per_worker=None, training_mode='default'):
+
+    # Build the fold index once, before any worker needs it
+    fold_index = load_fold_index()
+
+    # K fold cross validation, saving outputs for each fold
+    if fold_workers == 1:
+        fold_directories = [train_fold(model_name, k, image_cache, fold_index, threads_per_worker, training_mode)
+                            for k in range(FOLDS)]
+    else:
+        # Train folds in their own processes, each with a fresh TensorFlow session
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=fold_workers, mp_context=context, initializer=init_fold_worker,
+                                 initargs=(threads_per_worker,)) as executor:
+            fold_directories = list(executor.map(run_fold, [model_name] * FOLDS, range(FOLDS),
+                                                 [image_cache is not None] * FOLDS, [threads_per_worker] * FOLDS,
+                                                 [training_mode] * FOLDS))
+
+    # Merge the fold reports
+    aggregate_folds(fold_directories)
+
+
+def preprocess_image(filename, image_cache=None):
+    """
+    Load an image from IMG_DIRECTORY, or from the image cache, and prepare it for inference.
+    :param filename: Image filename relative to IMG_DIRECTORY
+    :param image_cache: Optional image cache returned by load_image_cache
+    :return: Preprocessed image and the time taken to preprocess it (s)
+    """
+    start_time = time()
+    # Load image
+    if image_cache is not None:
+        images, index = image_cache
+        img = images[index[filename]]
+    else:
+        img = imread(IMG_DIRECTORY + filename)
+    # Resize to 224x224
+    img = resize(img, IMG_SIZE)
+    # Scale from int to float
+    img = img * 1./255
+    return img, time() - start_time
+
+
+def preprocess_batch(executor, filenames, batch_size, image_cache=None, preprocess=preprocess_image):
+    """
+    Preprocess a batch of images on a pool of decode workers.
+    :param executor: Pool used to decode and resize images
+    :param filenames: Filenames in the batch, at most batch_size of them
+    :param batch_size: Fixed number of rows in the returned batch
+    :param image_cache: Optional image cache returned by load_image_cache
+    :param preprocess: Function from a filename and an image cache to a preprocessed image and its preprocessing time,
+    preprocess_image by default
+    :return: Batch of shape (batch_size, 224, 224, 3), zero padded at the end, and per image preprocessing times (s)
+    """
+    batch = np.zeros((batch_size,) + INPUT_SHAPE, dtype=np.float32)
+    preprocessing_times = []
+    images = executor.map(preprocess, filenames, [image_cache] * len(filenames))
+    for i, (img, preprocessing_time) in enumerate(images):
+        batch[i] = img
+        preprocessing_times.append(preprocessing_time)
+    return batch, preprocessing_times
+
+
+def inference(model, image_cache=None):
 
     # Create new output directory for saving inference times
     timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
@@ -339,16 +700,10 @@ def inference(model):
     preprocessing_times = []
     inference_times = []
     for i in range(image_count):
-        # Load image
-        start_time = time()
-        img = imread(IMG_DIRECTORY + filenames[i])
-        # Resize to 224x224
-        img = resize(img, (224, 224))
+        # Load, resize and scale image
+        img, preprocessing_time = preprocess_image(filenames[i], image_cache)
         # Map to batch
         img = np.expand_dims(img, axis=0)
-        # Scale from int to float
-        img = img * 1./255
-        preprocessing_time = time() - start_time
         start_time = time()
         # Predict label
         prediction = model.predict(img, batch_size=1, verbose=0)
@@ -367,20 +722,166 @@ def inference(model):
             writer.writerow([filenames[i], preprocessing_times[i] * 1000, inference_times[i] * 1000])
 
 
+def batch_inference(model, batch_size, decode_workers, image_cache=None):
+
+    # Create new output directory for saving inference times
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
+    output_directory = "{}{}/".format(OUTPUT_DIRECTORY, timestamp)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Load DeepWeeds dataframe and split the filenames into batches
+    dataframe = pd.read_csv(LABEL_DIRECTORY + "labels.csv")
+    image_count = dataframe.shape[0]
+    filenames = list(dataframe.Filename)
+    batches = [filenames[i:i + batch_size] for i in range(0, image_count, batch_size)]
+
+    preprocessing_times = []
+    inference_times = []
+    batch_times = []
+    # Batches are assembled on their own thread so that assembling never occupies a decode worker
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor, ThreadPoolExecutor(max_workers=1) as loader:
+        # Preprocess the first batch, then keep one batch in flight while the model runs
+        pending = loader.submit(preprocess_batch, executor, batches[0], batch_size, image_cache)
+        for k in range(len(batches)):
+            start_time = time()
+            batch, batch_preprocessing_times = pending.result()
+            wait_time = time() - start_time
+            if k + 1 < len(batches):
+                pending = loader.submit(preprocess_batch, executor, batches[k + 1], batch_size, image_cache)
+            start_time = time()
+            # Predict labels for the whole batch, discarding the zero padded rows
+            prediction = model.predict(batch, batch_size=batch_size, verbose=0)[:len(batches[k])]
+            y_pred = np.argmax(prediction, axis=1)
+            y_pred[np.max(prediction, axis=1) < 1/9] = 8
+            batch_time = time() - start_time
+            # Append times to lists, amortizing the batch inference time over its images
+            preprocessing_times.extend(batch_preprocessing_times)
+            inference_times.extend([batch_time / len(batches[k])] * len(batches[k]))
+            batch_times.append((len(batches[k]), wait_time, batch_time))
+
+    # Save per image inference times to csv
+    with open(output_directory + "tf_inference_times.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Filename', 'Preprocessing time (ms)', 'Inference time (ms)'])
+        for i in range(image_count):
+            writer.writerow([filenames[i], preprocessing_times[i] * 1000, inference_times[i] * 1000])
+
+    # Save per batch inference times to csv
+    with open(output_directory + "tf_batch_inference_times.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Batch', 'Images', 'Preprocessing wait (ms)', 'Batch inference time (ms)',
+                         'Amortized inference time per image (ms)'])
+        for k, (count, wait_time, batch_time) in enumerate(batch_times):
+            writer.writerow([k, count, wait_time * 1000, batch_time * 1000, batch_time * 1000 / count])
+
+
+def current_rss_mb():
+    """
+    Read the current resident set size of this process.
+    :return: Resident memory (MB), or NaN where /proc is not available
+    """
+    if not os.path.exists("/proc/self/statm"):
+        return float('nan')
+    with open("/proc/self/statm", 'r') as f:
+        resident_pages = int(f.read().split()[1])
+    return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024.)
+
+
+def benchmark(model_path, batch_sizes, thread_counts, image_count, warmup, image_cache=None):
+    """
+    Measure model latency and throughput for every combination of batch size and thread count.
+    :param model_path: Path to the .hdf5 model file
+    :param batch_sizes: Batch sizes to benchmark
+    :param thread_counts: Intra-op thread counts to benchmark
+    :param image_count: Number of images from labels.csv to benchmark over
+    :param warmup: Number of warm-up batches excluded from the results
+    :param image_cache: Optional image cache returned by load_image_cache
+    :return: List of benchmark results
+    """
+
+    # Create new output directory for saving the benchmark summary
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
+    output_directory = "{}{}/".format(OUTPUT_DIRECTORY, timestamp)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Preprocess the image subset once so that only the model is measured
+    filenames = list(pd.read_csv(LABEL_DIRECTORY + "labels.csv").Filename)[:image_count]
+    images = np.stack([preprocess_image(filename, image_cache)[0] for filename in filenames]).astype(np.float32)
+
+    results = []
+    for threads in thread_counts:
+        # Reload the model into a session with the requested thread pool
+        K.clear_session()
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                       inter_op_parallelism_threads=1)))
+        model = load_model(model_path)
+        for batch_size in batch_sizes:
+            start_rss_mb = current_rss_mb()
+            steps = warmup + int(np.ceil(len(images) / batch_size))
+            latencies = []
+            for step in range(steps):
+                # Cycle through the subset so that every batch has the same shape
+                batch = images[np.arange(step * batch_size, (step + 1) * batch_size) % len(images)]
+                start_time = time()
+                model.predict(batch, batch_size=batch_size, verbose=0)
+                latencies.append(time() - start_time)
+            latencies = np.array(latencies[warmup:]) * 1000
+            result = {
+                'threads': threads,
+                'batch_size': batch_size,
+                'batches': len(latencies),
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p95_ms': float(np.percentile(latencies, 95)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'per_image_p50_ms': float(np.percentile(latencies, 50) / batch_size),
+                'images_per_sec': float(len(latencies) * batch_size / (latencies.sum() / 1000)),
+                # Resident memory gained while running this configuration, as the process peak only ever grows
+                'rss_increase_mb': current_rss_mb() - start_rss_mb,
+            }
+            print(result)
+            results.append(result)
+
+    # Save the benchmark summary to json and csv
+    with open(output_directory + "benchmark.json", 'w') as file:
+        json.dump(results, file, indent=2)
+    with open(output_directory + "benchmark.csv", 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("Benchmark summary saved to " + output_directory)
+    return results
+
+
 if __name__ == '__main__':
     # Parse command line arguments
-    (command, model) = parse_args()
+    args = parse_args()
+    (command, model) = (args.command, args.model)
 
     # Download images and models (if necessary)
     download_images()
     download_models()
 
-    if command == "cross_validate":
+    # Memory-map the pre-decoded images (if requested)
+    image_cache = load_image_cache() if args.use_cache else None
+
+    if command == "build_cache":
+        # Decode all images once into the image cache
+        build_image_cache(args.decode_workers)
+    elif command == "benchmark":
+        if not model.endswith("hdf5"):
+            print("Error: You must supply a hdf5 model file to benchmark.")
+        else:
+            # Sweep batch sizes and thread counts over a subset of DeepWeeds images
+            benchmark(model, [int(b) for b in args.batch_sizes.split(',')],
+                      [int(t) for t in args.thread_counts.split(',')], args.images, args.warmup, image_cache)
+    elif command == "cross_validate":
         if not model == "resnet" and not model == "inception":
             print("Error: You must ask for either ""resnet"" or ""inception"".")
         else:
             # Train and test model on DeepWeeds with 5 fold cross validation
-            cross_validate(model)
+            cross_validate(model, image_cache, args.fold_workers, args.threads_per_worker, args.training_mode)
     else:
         if not model.endswith("hdf5"):
             print("Error: You must supply a hdf5 model file to perform inference.")
@@ -388,4 +889,7 @@ if __name__ == '__main__':
             # Construct model from hdf5 model file
             model = load_model(model)
             # Measure the speed of performing inference with the chosen model averaging over DeepWeeds images
-            inference(model)
+            if args.batch_size == 1 and args.decode_workers == 1:
+                inference(model, image_cache)
+            else:
+                batch_inference(model, args.batch_size, args.decode_workers, image_cache)
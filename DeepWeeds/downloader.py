@@ -0,0 +1,302 @@
+import os
+import json
+import hashlib
+from zipfile import ZipFile, BadZipFile
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Global paths
+CACHE_DIRECTORY = os.environ.get("DEEPWEEDS_CACHE", "./cache/")
+GOOGLE_DRIVE_URL = "https://docs.google.com/uc?export=download"
+
+# Global variables
+CHUNK_SIZE = 1024 * 1024
+RETRIES = 5
+
+
+class IncompleteDownload(IOError):
+    """
+    Raised when the server closes the connection before sending the whole file.
+    """
+    pass
+
+
+def sha256sum(path):
+    """
+    Compute the SHA-256 digest of a file.
+    :param path: Path to the file
+    :return: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_confirm_token(response):
+    for key, value in response.cookies.items():
+        if key.startswith('download_warning'):
+            return value
+
+    return None
+
+
+def expected_size(response, offset):
+    """
+    Work out the full size of the file being downloaded from the response headers.
+    :param response: Response to a (possibly ranged) GET request
+    :param offset: Number of bytes already downloaded, if the server honoured the range
+    :return: Size of the complete file in bytes, or None if the server did not say
+    """
+    content_range = response.headers.get('Content-Range')
+    if content_range is not None and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get('Content-Length')
+    if content_length is not None and content_length.isdigit() and response.status_code != 416:
+        return offset + int(content_length)
+    return None
+
+
+def resume_download(session, url, params, destination):
+    """
+    Stream url into destination, continuing from the bytes already in destination if the server supports ranges.
+    :param session: requests Session to download with
+    :param url: URL to download
+    :param params: Query parameters for the request
+    :param destination: Partial file to append to
+    :return:
+    """
+    offset = os.path.getsize(destination) if os.path.exists(destination) else 0
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    with session.get(url, params=params, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 416:
+            # The partial file should already hold the whole content
+            total = expected_size(response, offset)
+        else:
+            response.raise_for_status()
+            if response.headers.get('Content-Type', '').startswith('text/html'):
+                # Google Drive answers with an HTML page instead of the file when its quota is exceeded
+                raise IOError("Expected a file from {} but got an HTML page.".format(url))
+            if response.status_code != 206:
+                # The server ignored the range, so start again from the beginning
+                offset = 0
+            total = expected_size(response, offset)
+            with open(destination, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    if chunk:  # filter out keep-alive new chunks
+                        f.write(chunk)
+    size = os.path.getsize(destination) if os.path.exists(destination) else 0
+    if total is not None and size != total:
+        if size > total:
+            # Bytes past the end cannot be resumed from, so start again
+            os.remove(destination)
+        raise IncompleteDownload("Downloaded {} of {} bytes from {}.".format(size, total, url))
+
+
+def read_refs(cache_directory):
+    """
+    Read the mapping from download keys to the digests of their content.
+    :param cache_directory: Directory holding cached files by digest
+    :return: Dictionary from key to SHA-256 digest
+    """
+    refs_path = os.path.join(cache_directory, "refs.json")
+    if not os.path.exists(refs_path):
+        return {}
+    with open(refs_path, "r") as f:
+        return json.load(f)
+
+
+def write_refs(cache_directory, refs):
+    refs_path = os.path.join(cache_directory, "refs.json")
+    with open(refs_path + ".tmp", "w") as f:
+        json.dump(refs, f, indent=2, sort_keys=True)
+    os.replace(refs_path + ".tmp", refs_path)
+
+
+def evict(key, cache_directory=CACHE_DIRECTORY):
+    """
+    Forget a download, removing its cached file and its ref, so that the next fetch downloads it again.
+    :param key: Name identifying the download in the cache
+    :param cache_directory: Directory holding cached files by digest
+    :return:
+    """
+    refs = read_refs(cache_directory)
+    digest = refs.pop(key, None)
+    if digest is not None:
+        cached_path = os.path.join(cache_directory, digest)
+        if os.path.exists(cached_path):
+            os.remove(cached_path)
+        write_refs(cache_directory, refs)
+
+
+def cached(key, sha256=None, cache_directory=CACHE_DIRECTORY):
+    """
+    Look up a previously downloaded file in the cache.
+    :param key: Name identifying the download in the cache
+    :param sha256: Expected SHA-256 digest, or None to use the digest recorded for key
+    :param cache_directory: Directory holding cached files by digest
+    :return: Path to the verified file in the cache, or None if it is missing or corrupt
+    """
+    digest = sha256 or read_refs(cache_directory).get(key)
+    if digest is None:
+        return None
+    cached_path = os.path.join(cache_directory, digest)
+    if os.path.exists(cached_path) and sha256sum(cached_path) == digest:
+        return cached_path
+    # A missing or corrupt entry must not stay pinned in refs.json
+    evict(key, cache_directory)
+    return None
+
+
+def fetch(url, key, params=None, sha256=None, session=None, cache_directory=CACHE_DIRECTORY):
+    """
+    Download a file into the content-addressed cache, resuming interrupted downloads and verifying its checksum.
+    :param url: URL to download
+    :param key: Name identifying the download in the cache, e.g. a Google Drive id
+    :param params: Query parameters for the request
+    :param sha256: Expected SHA-256 digest, or None to trust the first complete download
+    :param session: requests Session to download with
+    :param cache_directory: Directory holding cached files by digest
+    :return: Path to the verified file in the cache
+    """
+    cached_path = cached(key, sha256, cache_directory)
+    if cached_path is not None:
+        return cached_path
+    if not os.path.exists(cache_directory):
+        os.makedirs(cache_directory)
+
+    session = session or requests.Session()
+    partial_path = os.path.join(cache_directory, key + ".part")
+    for attempt in range(RETRIES):
+        try:
+            resume_download(session, url, params, partial_path)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                IncompleteDownload) as e:
+            print("Download of {} interrupted ({}), retrying {}/{}".format(key, e, attempt + 1, RETRIES))
+    else:
+        raise IOError("Failed to download {} after {} attempts.".format(key, RETRIES))
+
+    digest = sha256sum(partial_path)
+    if sha256 is not None and digest != sha256:
+        os.remove(partial_path)
+        raise IOError("Checksum mismatch for {}: expected {}, got {}.".format(key, sha256, digest))
+    cached_path = os.path.join(cache_directory, digest)
+    os.replace(partial_path, cached_path)
+
+    # Remember which content this key resolved to
+    refs = read_refs(cache_directory)
+    refs[key] = digest
+    write_refs(cache_directory, refs)
+    return cached_path
+
+
+def fetch_google_drive_file(id, sha256=None, cache_directory=CACHE_DIRECTORY):
+    """
+    Download a Google Drive file into the cache, confirming the virus scan warning for large files.
+    :param id: Google Drive file id
+    :param sha256: Expected SHA-256 digest, or None to trust the first complete download
+    :param cache_directory: Directory holding cached files by digest
+    :return: Path to the verified file in the cache
+    """
+    cached_path = cached(id, sha256, cache_directory)
+    if cached_path is not None:
+        return cached_path
+
+    session = requests.Session()
+    params = {'id': id}
+    with session.get(GOOGLE_DRIVE_URL, params=params, stream=True, timeout=60) as response:
+        token = get_confirm_token(response)
+    if token:
+        params = {'id': id, 'confirm': token}
+    return fetch(GOOGLE_DRIVE_URL, id, params=params, sha256=sha256, session=session,
+                 cache_directory=cache_directory)
+
+
+def read_pins(pin_file):
+    """
+    Read the pinned digests of downloads.
+    :param pin_file: JSON file mapping download keys to their expected SHA-256 digests
+    :return: Dictionary from key to SHA-256 digest
+    """
+    if pin_file is None or not os.path.exists(pin_file):
+        return {}
+    with open(pin_file, "r") as f:
+        return json.load(f)
+
+
+def pin(key, digest, pin_file):
+    """
+    Record the digest of a verified download, so that every later download of key must match it.
+    :param key: Name identifying the download
+    :param digest: SHA-256 digest to pin
+    :param pin_file: JSON file mapping download keys to their expected SHA-256 digests
+    :return:
+    """
+    pins = read_pins(pin_file)
+    pins[key] = digest
+    with open(pin_file + ".tmp", "w") as f:
+        json.dump(pins, f, indent=2, sort_keys=True)
+    os.replace(pin_file + ".tmp", pin_file)
+
+
+def fetch_and_extract_google_drive_file(id, directory, sha256=None, cache_directory=CACHE_DIRECTORY, pin_file=None):
+    """
+    Make sure the contents of a zipped Google Drive file are extracted in directory, downloading it if needed.
+    :param id: Google Drive file id
+    :param directory: Directory to extract into
+    :param sha256: Expected SHA-256 digest, or None to use the digest pinned in pin_file
+    :param cache_directory: Directory holding cached files by digest
+    :param pin_file: Optional JSON file of pinned digests. A download that is not pinned yet is pinned once it has
+    been fully downloaded and extracted, so every later download must have the same content
+    :return:
+    """
+    sha256 = sha256 or read_pins(pin_file).get(id)
+    # Skip hashing the archive when this exact content was already extracted
+    digest = sha256 or read_refs(cache_directory).get(id)
+    if digest is not None and os.path.exists(os.path.join(directory, ".extracted-" + digest)):
+        return
+    zip_path = fetch_google_drive_file(id, sha256, cache_directory)
+    try:
+        extract(zip_path, directory)
+    except (BadZipFile, EOFError):
+        # A corrupt archive is dropped from the cache so that the next run downloads it again
+        evict(id, cache_directory)
+        raise
+    if pin_file is not None and sha256 is None:
+        pin(id, os.path.basename(zip_path), pin_file)
+
+
+def extract_members(zip_path, members, directory):
+    with ZipFile(zip_path, "r") as zip_ref:
+        for member in members:
+            zip_ref.extract(member, directory)
+
+
+def extract(zip_path, directory, workers=4):
+    """
+    Extract a zip file across a pool of threads, skipping it if the same archive was already extracted there.
+    :param zip_path: Path to the zip file
+    :param directory: Directory to extract into
+    :param workers: Number of extraction threads, each with its own handle on the zip file
+    :return:
+    """
+    marker = os.path.join(directory, ".extracted-" + os.path.basename(zip_path))
+    if os.path.exists(marker):
+        return
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with ZipFile(zip_path, "r") as zip_ref:
+        members = zip_ref.namelist()
+    # Create directories up front so that workers never race to create them
+    for member in members:
+        os.makedirs(os.path.dirname(os.path.join(directory, member)), exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(extract_members, [zip_path] * workers,
+                          [members[i::workers] for i in range(workers)], [directory] * workers))
+    open(marker, "w").close()
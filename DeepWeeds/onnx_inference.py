@@ -0,0 +1,160 @@
+import argparse
+import os
+import csv
+from time import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import onnxruntime
+from skimage.io import imread
+from skimage.transform import resize
+# Batches are assembled by the same code as the Keras inference path
+from deepweeds import preprocess_batch, OUTPUT_DIRECTORY, LABEL_DIRECTORY, MODEL_DIRECTORY, IMG_DIRECTORY, IMG_SIZE, \
+    INPUT_SHAPE, CLASSES
+
+# Global variables
+ONNX_OPSET = 11
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export DeepWeeds Keras models to ONNX and score them on the CPU.')
+    parser.add_argument("command", help="'export' or 'score'")
+    parser.add_argument('--model', default=MODEL_DIRECTORY + "resnet.hdf5",
+                        help="Path to .hdf5 file to export, or .onnx file to score.")
+    parser.add_argument('--batch-size', type=int, default=32, help="Number of images per inference batch.")
+    parser.add_argument('--threads', type=int, default=0, help="Intra-op threads for ONNX Runtime, 0 for all cores.")
+    parser.add_argument('--decode-workers', type=int, default=4, help="Number of threads decoding images.")
+    args = parser.parse_args()
+    return args
+
+
+def export(model_path):
+    """
+    Export a Keras .hdf5 model to an ONNX graph with a dynamic batch dimension, by freezing the TensorFlow 1.x graph
+    of the Keras session and converting the frozen graph.
+    :param model_path: Path to the .hdf5 model file
+    :return: Path to the .onnx model file, next to the .hdf5 file
+    """
+    # The converter is only needed to export, not to score
+    import tensorflow as tf
+    import tf2onnx
+    from keras import backend as K
+    from keras.models import load_model
+
+    # Build the graph in inference mode, so that batch normalisation uses its moving averages
+    K.set_learning_phase(0)
+    model = load_model(model_path)
+    session = K.get_session()
+    # The Keras input placeholder is (None, 224, 224, 3), so the batch dimension stays dynamic
+    input_names = [tensor.name for tensor in model.inputs]
+    output_names = [tensor.name for tensor in model.outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(),
+                                                             [name.split(':')[0] for name in output_names])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def)
+
+    with tf.Graph().as_default() as graph:
+        tf.import_graph_def(graph_def, name='')
+        onnx_graph = tf2onnx.tfonnx.process_tf_graph(graph, opset=ONNX_OPSET, input_names=input_names,
+                                                     output_names=output_names)
+    onnx_graph = tf2onnx.optimizer.optimize_graph(onnx_graph)
+    model_proto = onnx_graph.make_model(os.path.basename(model_path))
+    onnx_path = os.path.splitext(model_path)[0] + ".onnx"
+    with open(onnx_path, 'wb') as f:
+        f.write(model_proto.SerializeToString())
+    print("Exported " + model_path + " to " + onnx_path)
+    return onnx_path
+
+
+def preprocess_image(filename, image_cache=None):
+    """
+    Load an image and prepare it the same way as the TensorRT harness: nearest neighbour
+    downsampling to 224x224 and scaling to [0, 1].
+    :param filename: Image filename relative to IMG_DIRECTORY
+    :param image_cache: Unused, as images are always decoded like the TensorRT harness does
+    :return: Preprocessed image and the time taken to preprocess it (s)
+    """
+    start_time = time()
+    img = imread(IMG_DIRECTORY + filename)
+    img = resize(img, IMG_SIZE, order=0, preserve_range=True, anti_aliasing=False)
+    img = img.astype(np.float32) / 255.
+    return img, time() - start_time
+
+
+def score(onnx_path, batch_size, threads, decode_workers):
+    """
+    Score every DeepWeeds image with an ONNX model on the CPU, writing the same scores csv as the TensorRT harness.
+    :param onnx_path: Path to the .onnx model file
+    :param batch_size: Number of images per inference batch
+    :param threads: Intra-op threads for ONNX Runtime, 0 for all cores
+    :param decode_workers: Number of threads decoding images
+    :return:
+    """
+    # Create new output directory for saving scores and inference times
+    timestamp = datetime.fromtimestamp(time()).strftime('%Y%m%d-%H%M%S')
+    output_directory = "{}{}/".format(OUTPUT_DIRECTORY, timestamp)
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+
+    # Create the CPU inference session
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+    input_name = session.get_inputs()[0].name
+
+    # Load DeepWeeds dataframe and split the filenames into batches
+    dataframe = pd.read_csv(LABEL_DIRECTORY + "labels.csv")
+    image_count = dataframe.shape[0]
+    filenames = list(dataframe.Filename)
+    labels = list(dataframe.Label)
+    batches = [filenames[i:i + batch_size] for i in range(0, image_count, batch_size)]
+
+    scores = []
+    preprocessing_times = []
+    inference_times = []
+    with ThreadPoolExecutor(max_workers=decode_workers) as executor, ThreadPoolExecutor(max_workers=1) as loader:
+        # Preprocess the next batch while the current one is scored
+        pending = loader.submit(preprocess_batch, executor, batches[0], batch_size, None, preprocess_image)
+        for k in range(len(batches)):
+            batch, batch_preprocessing_times = pending.result()
+            if k + 1 < len(batches):
+                pending = loader.submit(preprocess_batch, executor, batches[k + 1], batch_size, None, preprocess_image)
+            start_time = time()
+            prediction = session.run(None, {input_name: batch[:len(batches[k])]})[0]
+            batch_time = time() - start_time
+            scores.extend(prediction)
+            preprocessing_times.extend(batch_preprocessing_times)
+            inference_times.extend([batch_time / len(batches[k])] * len(batches[k]))
+
+    # Save scores to csv in the format of the TensorRT harness
+    model_name = os.path.splitext(os.path.basename(onnx_path))[0]
+    with open(output_directory + model_name + "_scores.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Filename', 'Label'] + [str(c) for c in CLASSES])
+        for i in range(image_count):
+            writer.writerow([filenames[i], labels[i]] + list(scores[i]))
+
+    # Save inference times to csv
+    with open(output_directory + "onnx_inference_times.csv", 'w', newline='') as file:
+        writer = csv.writer(file, delimiter=',')
+        writer.writerow(['Filename', 'Preprocessing time (ms)', 'Inference time (ms)'])
+        for i in range(image_count):
+            writer.writerow([filenames[i], preprocessing_times[i] * 1000, inference_times[i] * 1000])
+    print("Scores and inference times saved to " + output_directory)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    args = parse_args()
+
+    if args.command == "export":
+        if not args.model.endswith("hdf5"):
+            print("Error: You must supply a hdf5 model file to export.")
+        else:
+            export(args.model)
+    else:
+        if not args.model.endswith("onnx"):
+            print("Error: You must supply an onnx model file to score.")
+        else:
+            score(args.model, args.batch_size, args.threads, args.decode_workers)
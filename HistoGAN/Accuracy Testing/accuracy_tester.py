@@ -6,7 +6,7 @@ import torch.nn as nn
 from os.path import join, isfile, isdir
 from os import listdir
 from torchvision import datasets, models, transforms
-from utils import get_classes, get_dataset
+from utils import get_classes, get_dataset, predict_dataset
 
 CONFIDENCE_LEVEL = 0.95
 
@@ -25,11 +25,6 @@ def get_accuracy(model, input_folder, class_num_direc):
     # Get classes
     classes = get_classes(input_folder)
 
-    # Load in the model
-    active_model = torch.load(model)
-    active_model.eval()
-    print("Loaded the model")
-
     # dictionary - key: class, value: [correct, total]
     counters = {}
     for tissue_class in classes:
@@ -45,32 +40,24 @@ def get_accuracy(model, input_folder, class_num_direc):
         if tissue_class.startswith("."):
             continue
         image_dataset = get_dataset(os.path.join(input_folder, tissue_class))
-        dataloader = torch.utils.data.DataLoader(
-            image_dataset,
-            batch_size=16,
-            shuffle=False,
-            num_workers=4)
-
-        for test_inputs, test_labels in dataloader:
-            # Model predictions
-            test_inputs = test_inputs.to(device)
-            test_outputs = active_model(test_inputs)
-            softmax_test_outputs = nn.Softmax()(test_outputs)
-            confidences, test_preds = torch.max(softmax_test_outputs, 1)
-
-            for i in range(test_preds.shape[0]):
-                confidence = confidences[i].data.item()
-                predicted_class = class_num_to_class[test_preds[i].data.item()]
-                # Check if prediction is correct
-                if predicted_class is tissue_class:
-                    counters[tissue_class] = (counters.get(tissue_class)[0]+1,
-                                              counters.get(tissue_class)[1])
-                    correctness.append(1)
-                else:
-                    correctness.append(0)
-
-                counters[tissue_class] = [counters.get(tissue_class)[0],
-                                          counters.get(tissue_class)[1]+1]
+
+        # Model predictions, from the cache where possible
+        softmax_test_outputs = predict_dataset(model, image_dataset, device)
+        confidences, test_preds = softmax_test_outputs.max(axis=1), softmax_test_outputs.argmax(axis=1)
+
+        for i in range(test_preds.shape[0]):
+            confidence = confidences[i]
+            predicted_class = class_num_to_class[test_preds[i]]
+            # Check if prediction is correct
+            if predicted_class is tissue_class:
+                counters[tissue_class] = (counters.get(tissue_class)[0]+1,
+                                          counters.get(tissue_class)[1])
+                correctness.append(1)
+            else:
+                correctness.append(0)
+
+            counters[tissue_class] = [counters.get(tissue_class)[0],
+                                      counters.get(tissue_class)[1]+1]
         print("{}: {:.3}".format(
             tissue_class,
             counters.get(tissue_class)[0]/counters.get(tissue_class)[1]))
@@ -1,5 +1,22 @@
+import io
+import os
+import sys
+from os import listdir
 from os.path import join, isfile, isdir
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision
 from torchvision import datasets, transforms
+from PIL import Image
+
+# The prediction cache is shared with the ResNet scripts
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'ResNet'))
+from utils_cache import PredictionCache, file_digest, content_digest
+
+# Same default as the ResNet config, point PREDICTION_CACHE at one file to share predictions with it
+CACHE_PATH = os.environ.get("PREDICTION_CACHE", "prediction_cache/predictions.sqlite")
+CACHE_SIZE_MB = 2000
 
 
 # getting the classes for classification
@@ -28,3 +45,70 @@ def get_dataset(data_path):
         ]),
     }
     return datasets.ImageFolder(data_path, data_transforms['normalize'])
+
+
+# Load a ResNet checkpoint, either a whole pickled model or a state dict checkpoint saved by the ResNet trainer
+def load_model(model_path):
+    checkpoint = torch.load(model_path, map_location="cpu")
+    if not (isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint):
+        return checkpoint
+    architecture = getattr(torchvision.models, 'resnet' + str(checkpoint['num_layers']))
+    model = architecture(pretrained=False, num_classes=checkpoint['num_classes'])
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model
+
+
+# Digests of model checkpoints already hashed in this process
+MODEL_DIGESTS = {}
+
+
+# Images of an ImageFolder dataset with the content digest of each, read from the same bytes that are decoded,
+# so that the dataloader workers hash the images for the prediction cache and each image is read only once
+class DigestedImageFolder(torch.utils.data.Dataset):
+    def __init__(self, image_dataset):
+        self.image_dataset = image_dataset
+
+    def __len__(self):
+        return len(self.image_dataset)
+
+    def __getitem__(self, idx):
+        with open(self.image_dataset.samples[idx][0], 'rb') as f:
+            content = f.read()
+        image = Image.open(io.BytesIO(content)).convert('RGB')
+        if self.image_dataset.transform is not None:
+            image = self.image_dataset.transform(image)
+        return image, content_digest(content)
+
+
+# Softmax outputs of a model for every image of an ImageFolder dataset, in dataset order
+# Predictions are cached by checkpoint and image content, so the model only runs on images it has not seen
+def predict_dataset(model_path, image_dataset, device, batch_size=16):
+    if model_path not in MODEL_DIGESTS:
+        MODEL_DIGESTS[model_path] = file_digest(model_path)
+    cache = PredictionCache(CACHE_PATH, CACHE_SIZE_MB)
+    dataloader = torch.utils.data.DataLoader(
+        DigestedImageFolder(image_dataset), batch_size=batch_size, shuffle=False, num_workers=4)
+    active_model = None
+    probs = []
+    num_cached = 0
+    with torch.no_grad():
+        for test_inputs, digests in dataloader:
+            keys = [cache.key(MODEL_DIGESTS[model_path], digest) for digest in digests]
+            key_to_probs = cache.get_many(keys)
+            missing = [i for i, key in enumerate(keys) if key not in key_to_probs]
+            batch_probs = [key_to_probs.get(key) for key in keys]
+            if len(missing) > 0:
+                # The model is only loaded once an image is missing from the cache
+                if active_model is None:
+                    active_model = load_model(model_path).to(device)
+                    active_model.eval()
+                test_outputs = active_model(test_inputs[missing].to(device))
+                missing_probs = nn.Softmax(dim=1)(test_outputs).cpu().numpy()
+                cache.put_many([keys[i] for i in missing], missing_probs)
+                for i, row in zip(missing, missing_probs):
+                    batch_probs[i] = row
+            num_cached += len(keys) - len(missing)
+            probs.extend(batch_probs)
+    print("{} of {} predictions found in the cache".format(num_cached, len(probs)))
+    cache.close()
+    return np.array(probs, dtype=np.float32).reshape(len(probs), -1)
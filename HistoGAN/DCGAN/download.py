@@ -13,98 +13,53 @@ import sys
 import gzip
 import json
 import shutil
-import zipfile
 import argparse
-import requests
-import subprocess
-from tqdm import tqdm
 from six.moves import urllib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, BadZipFile
+
+# downloads go through the shared download layer of DeepWeeds: resumed, length and checksum verified, and cached by content
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'DeepWeeds'))
+from downloader import fetch, fetch_google_drive_file, extract, evict
 
 parser = argparse.ArgumentParser(description='Download dataset for DCGAN.')
 parser.add_argument('datasets', metavar='N', type=str, nargs='+', choices=['celebA', 'lsun', 'mnist'],
            help='name of dataset to download [celebA, lsun, mnist]')
 
-def download(url, dirpath):
-  filename = url.split('/')[-1]
-  filepath = os.path.join(dirpath, filename)
-  u = urllib.request.urlopen(url)
-  f = open(filepath, 'wb')
-  filesize = int(u.headers["Content-Length"])
-  print("Downloading: %s Bytes: %s" % (filename, filesize))
-
-  downloaded = 0
-  block_sz = 8192
-  status_width = 70
-  while True:
-    buf = u.read(block_sz)
-    if not buf:
-      print('')
-      break
-    else:
-      print('', end='\r')
-    downloaded += len(buf)
-    f.write(buf)
-    status = (("[%-" + str(status_width + 1) + "s] %3.2f%%") %
-      ('=' * int(float(downloaded) / filesize * status_width) + '>', downloaded * 100. / filesize))
-    print(status, end='')
-    sys.stdout.flush()
-  f.close()
-  return filepath
-
-def download_file_from_google_drive(id, destination):
-  URL = "https://docs.google.com/uc?export=download"
-  session = requests.Session()
-
-  response = session.get(URL, params={ 'id': id }, stream=True)
-  token = get_confirm_token(response)
-
-  if token:
-    params = { 'id' : id, 'confirm' : token }
-    response = session.get(URL, params=params, stream=True)
-
-  save_response_content(response, destination)
-
-def get_confirm_token(response):
-  for key, value in response.cookies.items():
-    if key.startswith('download_warning'):
-      return value
-  return None
-
-def save_response_content(response, destination, chunk_size=32*1024):
-  total_size = int(response.headers.get('content-length', 0))
-  with open(destination, "wb") as f:
-    for chunk in tqdm(response.iter_content(chunk_size), total=total_size,
-              unit='B', unit_scale=True, desc=destination):
-      if chunk: # filter out keep-alive new chunks
-        f.write(chunk)
-
-def unzip(filepath):
-  print("Extracting: " + filepath)
-  dirpath = os.path.dirname(filepath)
-  with zipfile.ZipFile(filepath) as zf:
-    zf.extractall(dirpath)
-  os.remove(filepath)
+def link_or_copy(src, dst):
+  # the cached file is linked into the data directory, or copied through a temporary file on another filesystem
+  if os.path.exists(dst):
+    return
+  try:
+    os.link(src, dst)
+  except OSError:
+    shutil.copy2(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+
+def gunzip(src, dst):
+  with gzip.open(src, 'rb') as f_in, open(dst + '.tmp', 'wb') as f_out:
+    shutil.copyfileobj(f_in, f_out, 1024*1024)
+  os.replace(dst + '.tmp', dst)
 
 def download_celeb_a(dirpath):
-  data_dir = 'celebA'
-  if os.path.exists(os.path.join(dirpath, data_dir)):
+  data_dir = os.path.join(dirpath, 'celebA')
+  if os.path.exists(os.path.join(data_dir, '.done')):
     print('Found Celeb-A - skip')
     return
 
-  filename, drive_id  = "img_align_celeba.zip", "0B7EVK8r0v71pZjFTYXZWM3FlRnM"
-  save_path = os.path.join(dirpath, filename)
-
-  if os.path.exists(save_path):
-    print('[*] {} already exists'.format(save_path))
-  else:
-    download_file_from_google_drive(drive_id, save_path)
-
-  zip_dir = ''
-  with zipfile.ZipFile(save_path) as zf:
-    zip_dir = zf.namelist()[0]
-    zf.extractall(dirpath)
-  os.remove(save_path)
-  os.rename(os.path.join(dirpath, zip_dir), os.path.join(dirpath, data_dir))
+  drive_id = "0B7EVK8r0v71pZjFTYXZWM3FlRnM"
+  zip_path = fetch_google_drive_file(drive_id)
+  try:
+    with ZipFile(zip_path) as zf:
+      zip_dir = zf.namelist()[0].rstrip('/')
+    extract(zip_path, dirpath)
+  except (BadZipFile, EOFError):
+    # a corrupt archive is dropped from the cache so that the next run downloads it again
+    evict(drive_id)
+    raise
+  if not os.path.exists(data_dir):
+    os.rename(os.path.join(dirpath, zip_dir), data_dir)
+  open(os.path.join(data_dir, '.done'), 'w').close()
 
 def _list_categories(tag):
   url = 'http://lsun.cs.princeton.edu/htbin/list.cgi?tag=' + tag
@@ -119,17 +74,15 @@ def _download_lsun(out_dir, category, set_name, tag):
     out_name = 'test_lmdb.zip'
   else:
     out_name = '{category}_{set_name}_lmdb.zip'.format(**locals())
-  out_path = os.path.join(out_dir, out_name)
-  cmd = ['curl', url, '-o', out_path]
   print('Downloading', category, set_name, 'set')
-  subprocess.call(cmd)
+  link_or_copy(fetch(url, 'lsun_' + out_name), os.path.join(out_dir, out_name))
 
 def download_lsun(dirpath):
   data_dir = os.path.join(dirpath, 'lsun')
-  if os.path.exists(data_dir):
+  if os.path.exists(os.path.join(data_dir, '.done')):
     print('Found LSUN - skip')
     return
-  else:
+  elif not os.path.exists(data_dir):
     os.mkdir(data_dir)
 
   tag = 'latest'
@@ -140,29 +93,33 @@ def download_lsun(dirpath):
     _download_lsun(data_dir, category, 'train', tag)
     _download_lsun(data_dir, category, 'val', tag)
   _download_lsun(data_dir, '', 'test', tag)
+  open(os.path.join(data_dir, '.done'), 'w').close()
+
+def _download_mnist_file(data_dir, url_base, file_name):
+  out_path = os.path.join(data_dir, file_name[:-len('.gz')])
+  if os.path.exists(out_path):
+    return
+  print('Downloading ', file_name)
+  gz_path = fetch(url_base + file_name, 'mnist_' + file_name)
+  print('Decompressing ', file_name)
+  gunzip(gz_path, out_path)
 
 def download_mnist(dirpath):
   data_dir = os.path.join(dirpath, 'mnist')
-  if os.path.exists(data_dir):
+  if os.path.exists(os.path.join(data_dir, '.done')):
     print('Found MNIST - skip')
     return
-  else:
+  elif not os.path.exists(data_dir):
     os.mkdir(data_dir)
   url_base = 'http://yann.lecun.com/exdb/mnist/'
   file_names = ['train-images-idx3-ubyte.gz',
                 'train-labels-idx1-ubyte.gz',
                 't10k-images-idx3-ubyte.gz',
                 't10k-labels-idx1-ubyte.gz']
-  for file_name in file_names:
-    url = (url_base+file_name).format(**locals())
-    print(url)
-    out_path = os.path.join(data_dir,file_name)
-    cmd = ['curl', url, '-o', out_path]
-    print('Downloading ', file_name)
-    subprocess.call(cmd)
-    cmd = ['gzip', '-d', out_path]
-    print('Decompressing ', file_name)
-    subprocess.call(cmd)
+  # the four files are fetched and decompressed concurrently
+  with ThreadPoolExecutor(max_workers=len(file_names)) as executor:
+    list(executor.map(lambda file_name: _download_mnist_file(data_dir, url_base, file_name), file_names))
+  open(os.path.join(data_dir, '.done'), 'w').close()
 
 def prepare_data_dir(path = './data'):
   if not os.path.exists(path):
@@ -6,92 +6,127 @@
 import config
 from utils import *
 
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+#copy through a temporary file, so an interrupted copy never leaves a partial slide that a rerun would skip
+def copy_atomic(src, dst):
+	shutil.copy2(src, dst + '.tmp')
+	os.replace(dst + '.tmp', dst)
+
+#place one image in its split folder, skipping it if a previous run already did
+#hardlinks fall back to a copy, and moves to a copy and delete, when the output is on another filesystem
+def place(src, dst, mode):
+	if os.path.exists(dst):
+		return False
+	if os.path.lexists(dst): #a symlink whose slide has gone
+		os.remove(dst)
+	if mode == 'move':
+		try:
+			os.rename(src, dst)
+		except OSError:
+			copy_atomic(src, dst)
+			os.remove(src)
+	elif mode == 'symlink':
+		os.symlink(os.path.abspath(src), dst)
+	elif mode == 'hardlink':
+		try:
+			os.link(src, dst)
+		except OSError:
+			copy_atomic(src, dst)
+	else:
+		copy_atomic(src, dst)
+	return True
+
+#images of a class folder, leaving out temporary files of interrupted copies
+def get_slide_paths(folder):
+	return [image_path for image_path in get_image_paths(folder) if not image_path.endswith('.tmp')]
+
+#write a labels csv to a temporary file first, so a crash never leaves a half written csv
+def write_labels_csv(labels_csv, img_to_label):
+	confirm_output_folder(basefolder(labels_csv) or '.')
+	writer = open(labels_csv + '.tmp', 'w')
+	writer.write('img,gt\n')
+	for img in sorted(img_to_label.keys()):
+		writer.write(img + ',' + img_to_label[img] + '\n')
+	writer.close()
+	os.replace(labels_csv + '.tmp', labels_csv)
+
 #main function
 #note that we want the validation and test sets to be balanced
-def split(all_wsi, train_folder, val_folder, test_folder, val_split, test_split, keep_orig_copy, labels_train, labels_val, labels_test):
+#each class is shuffled with its own seed, so the split only depends on the seed and the image names
+def split(all_wsi, train_folder, val_folder, test_folder, val_split, test_split, keep_orig_copy, labels_train, labels_val, labels_test, mode=config.split_mode, seed=config.split_seed, workers=config.split_workers):
 
-	head = 'cp' if keep_orig_copy else 'mv' #based on whether we want to move or keep the files
+	mode = mode if keep_orig_copy else 'move' #based on whether we want to move or keep the files
+	split_folders = [train_folder, val_folder, test_folder]
 
 	#create folders
-	for folder in [train_folder, val_folder, test_folder]:
+	for folder in split_folders:
 		subfolders = [join(folder, _class) for _class in config.classes]
 		for subfolder in subfolders:
-			confirm_output_folder(subfolder) 
-
-	train_img_to_label = {}
-	val_img_to_label = {}
-	test_img_to_label = {}
+			confirm_output_folder(subfolder)
 
-	#sort the images and move/copy them appropriately
-	subfolder_paths = get_subfolder_paths(all_wsi)
-	for subfolder in subfolder_paths:
+	split_img_to_label = [{}, {}, {}] #train, val, test
+	jobs = [] #(source, destination) of every image
 
-		image_paths = get_image_paths(subfolder)
-		assert len(image_paths) > val_split + test_split #make sure we have enough slides in each class
+	#assign every image of each class to a split
+	for subfolder in get_subfolder_paths(all_wsi):
 
-		#assign training, test, and val images
-		test_idx = len(image_paths) - test_split
-		val_idx = test_idx - val_split
-		train_images = image_paths[:val_idx]
-		val_images = image_paths[val_idx:test_idx]
-		test_images = image_paths[test_idx:]
-		print('class '+subfolder.split('/')[-1]+ ':', '#train='+str(len(train_images)), '#val='+str(len(val_images)), '#test='+str(len(test_images)))
-
-		#move train
-		for train_image in train_images:
-			output_path = '/'.join([train_folder, '/'.join(train_image.split('/')[1:])])
-			os.system(' '.join([head, train_image, output_path]))
-			img_name = train_image.split('/')[-1]
-			img_class = train_image.split('/')[-2]
-			train_img_to_label[img_name] = img_class
-			#writer_train.write(img_name + ',' + img_class + '\n')
-
-		#move val
-		for val_image in val_images:
-			output_path = '/'.join([val_folder, '/'.join(val_image.split('/')[1:])])
-			os.system(' '.join([head, val_image, output_path]))
-			img_name = val_image.split('/')[-1]
-			img_class = val_image.split('/')[-2]
-			val_img_to_label[img_name] = img_class
-			#writer_val.write(img_name + ',' + img_class + '\n')
-
-		#move test
-		for test_image in test_images:
-			output_path = '/'.join([test_folder, '/'.join(test_image.split('/')[1:])])
-			os.system(' '.join([head, test_image, output_path]))
-			img_name = test_image.split('/')[-1]
-			img_class = test_image.split('/')[-2]
-			test_img_to_label[img_name] = img_class
-			#writer_test.write(img_name + ',' + img_class + '\n')
+		_class = subfolder.split('/')[-1]
 
+		#images already moved out by a previous run still count, so reruns give the same split
+		name_to_path = {}
+		for folder in split_folders:
+			name_to_path.update({basename(image_path): image_path for image_path in get_slide_paths(join(folder, _class))})
+		name_to_path.update({basename(image_path): image_path for image_path in get_slide_paths(subfolder)})
 
-	#for making the csv files
-	writer_train = open(labels_train, 'w')
-	writer_train.write('img,gt\n')
-	for img in sorted(train_img_to_label.keys()):
-		writer_train.write(img + ',' + train_img_to_label[img] + '\n')
+		image_names = sorted(name_to_path.keys())
+		assert len(image_names) > val_split + test_split #make sure we have enough slides in each class
+		random.Random(str(seed) + '-' + _class).shuffle(image_names)
 
-	writer_val = open(labels_val, 'w')
-	writer_val.write('img,gt\n')
-	for img in sorted(val_img_to_label.keys()):
-		writer_val.write(img + ',' + val_img_to_label[img] + '\n')
+		#assign training, test, and val images
+		test_images = image_names[:test_split]
+		val_images = image_names[test_split:test_split+val_split]
+		train_images = image_names[test_split+val_split:]
+		print('class '+_class+ ':', '#train='+str(len(train_images)), '#val='+str(len(val_images)), '#test='+str(len(test_images)))
+
+		for folder, images, img_to_label in zip(split_folders, [train_images, val_images, test_images], split_img_to_label):
+			for img_name in images:
+				jobs.append((name_to_path[img_name], join(folder, _class, img_name)))
+				img_to_label[img_name] = _class
+
+	#link, copy or move the images on a pool of threads
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		num_placed = sum(executor.map(lambda job: place(job[0], job[1], mode), jobs))
+	print(num_placed, 'of', len(jobs), 'images placed with mode', mode + ',', len(jobs) - num_placed, 'were already in place')
+
+	#remove what an earlier run with another seed or split size left in a split, so that no slide ends up in two splits
+	#this runs after placing, so that slides moved by an earlier run have already been moved on to their new split
+	num_removed = 0
+	for folder, img_to_label in zip(split_folders, split_img_to_label):
+		for subfolder in get_subfolder_paths(folder):
+			for image_path in get_image_paths(subfolder):
+				if img_to_label.get(basename(image_path)) != subfolder.split('/')[-1]:
+					os.remove(image_path)
+					num_removed += 1
+	if num_removed > 0:
+		print(num_removed, 'images no longer assigned to their split were removed')
 
-	writer_test = open(labels_test, 'w')
-	writer_test.write('img,gt\n')
-	for img in sorted(test_img_to_label.keys()):
-		writer_test.write(img + ',' + test_img_to_label[img] + '\n')
+	#for making the csv files
+	for labels_csv, img_to_label in zip([labels_train, labels_val, labels_test], split_img_to_label):
+		write_labels_csv(labels_csv, img_to_label)
 
 if __name__ == '__main__':
 
-	split(	all_wsi = config.all_wsi, 
-			train_folder = config.wsi_train, 
-			val_folder = config.wsi_val, 
-			test_folder = config.wsi_test, 
-			val_split = config.val_wsi_per_class, 
+	split(	all_wsi = config.all_wsi,
+			train_folder = config.wsi_train,
+			val_folder = config.wsi_val,
+			test_folder = config.wsi_test,
+			val_split = config.val_wsi_per_class,
 			test_split = config.test_wsi_per_class,
 			keep_orig_copy = config.keep_orig_copy,
 			labels_train = config.labels_train,
 			labels_val = config.labels_val,
 			labels_test = config.labels_test
 		)
-
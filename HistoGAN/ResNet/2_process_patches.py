@@ -1,5 +1,4 @@
 
-import utils_processing
 from utils_processing import *
 
 
@@ -8,19 +7,20 @@ from utils_processing import *
 ###########################################
 
 #generate train_patches
-# gen_train_patches(config.wsi_train, config.train_patches, config.num_train_per_class)
+# gen_train_patches(config.wsi_train, config.train_patches, config.num_train_per_class, workers = config.patch_workers)
 
-#balance the training patches
-balance_classes(config.train_patches)
+#balance the training patches on disk, unless they are balanced at load time (shards are never duplicated on disk)
+if config.patch_store == 'jpeg' and not config.virtual_balance:
+	balance_classes(config.train_patches)
 
 #generate val patches
-# gen_val_patches(config.wsi_val, config.val_patches, overlap_factor = 1.5)
+# gen_val_patches(config.wsi_val, config.val_patches, overlap_factor = 1.5, workers = config.patch_workers)
 
 #generate train_eval_patches (this will probably take up a lot of space, so only use for serious debugging)
-#gen_patches_by_folder(config.wsi_train, config.patches_eval_train, config.slide_overlap)
+#gen_patches_by_folder(config.wsi_train, config.patches_eval_train, config.slide_overlap, workers = config.patch_workers)
 
 #generate val_eval_patches
-# gen_patches_by_folder(config.wsi_val, config.patches_eval_val, config.slide_overlap)
+# gen_patches_by_folder(config.wsi_val, config.patches_eval_val, config.slide_overlap, workers = config.patch_workers)
 
 #generate test_eval_patches
-# gen_patches_by_folder(config.wsi_test, config.patches_eval_test, config.slide_overlap)
+# gen_patches_by_folder(config.wsi_test, config.patches_eval_test, config.slide_overlap, workers = config.patch_workers)
@@ -11,11 +11,13 @@ get_predictions(	patches_eval_folder = config.patches_eval_val,
 					auto_select = config.auto_select, 
 					eval_model = config.eval_model, 
 					checkpoints_folder = config.checkpoints_folder, 
-					output_folder = config.preds_val)
+					output_folder = config.preds_val,
+					wsi_folder = config.wsi_val if config.predict_from_slides else None)
 
 #test patches
 get_predictions(	patches_eval_folder = config.patches_eval_test, 
 					auto_select = config.auto_select, 
 					eval_model = config.eval_model, 
 					checkpoints_folder = config.checkpoints_folder, 
-					output_folder = config.preds_test)
\ No newline at end of file
+					output_folder = config.preds_test,
+					wsi_folder = config.wsi_test if config.predict_from_slides else None)
\ No newline at end of file
@@ -0,0 +1,73 @@
+# DeepSlide
+# Jason Wei, Behnaz Abdollahi, Saeed Hassanpour
+
+#Checks that the vectorized whitespace filters give the same answers as the original double loop.
+#Run with python check_is_purple.py, it exits with an error on the first mismatch.
+
+import argparse
+import numpy as np
+import skimage.measure
+
+from utils_processing import is_purple_dot, is_purple, is_purple_windows
+
+#the original is_purple, which walks the pooled grid in a python double loop
+def legacy_is_purple(crop):
+	pooled = skimage.measure.block_reduce(crop, (int(crop.shape[0]/15), int(crop.shape[1]/15), 1), np.average)
+	num_purple_squares = 0
+	for x in range(pooled.shape[0]):
+		for y in range(pooled.shape[1]):
+			r = pooled[x, y, 0]
+			g = pooled[x, y, 1]
+			b = pooled[x, y, 2]
+			if is_purple_dot(r, g, b):
+				num_purple_squares += 1
+	if num_purple_squares > 100:
+		return True
+	return False
+
+#a random slide of white background with purple blobs of tissue, so that windows land on both sides of the threshold
+def synthetic_slide(rng, height, width):
+	slide = rng.integers(215, 256, size=(height, width, 3)).astype(np.uint8)
+	for _ in range(rng.integers(2, 8)):
+		x, y = rng.integers(0, height), rng.integers(0, width)
+		h, w = rng.integers(height//8, height//2), rng.integers(width//8, width//2)
+		tissue = slide[x:x+h, y:y+w]
+		tissue[..., 0] = rng.integers(120, 200, size=tissue.shape[:2])
+		tissue[..., 1] = rng.integers(40, 140, size=tissue.shape[:2])
+		tissue[..., 2] = rng.integers(120, 220, size=tissue.shape[:2])
+	return slide
+
+#window starts for the given overlap, as in produce_patches
+def window_starts(length, window_size, inverse_overlap_factor):
+	steps = int((length-window_size) / window_size * inverse_overlap_factor)
+	step_size = int(window_size / inverse_overlap_factor)
+	return [i*step_size for i in range(steps+1)]
+
+def check(num_slides, seed):
+	rng = np.random.default_rng(seed)
+	num_windows, num_purple = 0, 0
+	for slide_num in range(num_slides):
+		height, width = rng.integers(600, 1200), rng.integers(600, 1200)
+		slide = synthetic_slide(rng, height, width)
+		#224 takes the running sum path, 200 is not a multiple of its block size and falls back to is_purple
+		for window_size in [224, 200]:
+			for inverse_overlap_factor in [1, 2, 3]:
+				x_starts = window_starts(height, window_size, inverse_overlap_factor)
+				y_starts = window_starts(width, window_size, inverse_overlap_factor)
+				purple_windows = is_purple_windows(slide, x_starts, y_starts, window_size)
+				for i, x in enumerate(x_starts):
+					for j, y in enumerate(y_starts):
+						crop = slide[x:x+window_size, y:y+window_size, :]
+						expected = legacy_is_purple(crop)
+						assert is_purple(crop) == expected, 'is_purple differs on slide ' + str(slide_num) + ' at ' + str((x, y, window_size))
+						assert purple_windows[i, j] == expected, 'is_purple_windows differs on slide ' + str(slide_num) + ' at ' + str((x, y, window_size))
+						num_windows += 1
+						num_purple += int(expected)
+	print('is_purple and is_purple_windows match the loop on all', num_windows, 'windows,', num_purple, 'of them purple')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare the vectorized is_purple filters against the original loop.')
+	parser.add_argument('--slides', type=int, default=6, help='number of synthetic slides to check')
+	parser.add_argument('--seed', type=int, default=0, help='seed for the synthetic slides')
+	args = parser.parse_args()
+	check(args.slides, args.seed)
@@ -20,6 +20,9 @@ all_wsi = 'train_folder/train/'
 val_wsi_per_class = 20 #for splitting into validation set
 test_wsi_per_class = 30 #for splitting into testing set, remaining images used in train
 keep_orig_copy = True #when splitting, do you want to just move them or make a copy?
+split_mode = 'hardlink' #how kept copies are made: 'hardlink' (falls back to a copy across filesystems), 'symlink', or 'copy'
+split_seed = 0 #the same seed and slide names always give the same split
+split_workers = 8 #threads linking, copying, or moving the slides
 
 ###########################################
 ################ GENERAL ##################
@@ -64,6 +67,10 @@ patches_eval_test = 'patches_eval_test'
 # target number of training samples per class
 num_train_per_class = 80000
 
+#balance classes at load time by drawing num_train_per_class patches of each class every epoch
+#if False, 2_process_patches.py duplicates patches on disk until every class matches the largest one
+virtual_balance = True
+
 #only looks for purple images and automatically filters whitespace
 type_histopath = True
 
@@ -73,6 +80,14 @@ type_histopath = True
 #recommend 2 for very high res, 3 for medium, and 5 for not extremely high res images
 slide_overlap = 3
 
+#number of processes generating patches, each working through one wsi at a time
+patch_workers = 4
+
+#how patches are stored: 'jpeg' writes one jpeg per window in class/slide subfolders,
+#'shards' packs them into large sequential shard files with an index.csv of (slide, x, y, class)
+patch_store = 'jpeg'
+shard_size_mb = 256 #size at which a new shard file is started
+
 ###########################################
 ################ TRAINING #################
 ###########################################
@@ -88,10 +103,22 @@ resume_checkpoint = False
 resume_checkpoint_path = 'checkpoints/xyz.pt' #only used if resume_checkpoint is True
 save_interval = 1
 checkpoints_folder = 'checkpoints' #where models are saved
+keep_top_k = 3 #number of checkpoints kept, by validation accuracy. None keeps them all
 pretrain = False #imagenet pretrain?
 log_folder = 'logs'
 log_csv = get_log_csv_name(log_folder) #is named with date and time
 
+#data loading
+num_workers = 4 #processes loading batches for each dataloader
+pin_memory = False #page-locked batches for faster copies to the gpu, turn on when training on a gpu
+persistent_workers = True #keep loader processes alive between epochs
+prefetch_factor = 2 #batches loaded ahead by each worker
+mixed_precision = False #bfloat16 autocast for the forward pass, on the cpu as well as the gpu
+channels_last = False #channels last memory format for the model and its inputs, usually faster on the cpu
+batch_augment = False #flips, rotations and color jitter on whole uint8 batches on the device instead of per image in the workers
+
+conf_matrix_window = 10000 #confusion matrices printed each epoch cover the last this many samples, None for the whole epoch
+
 ###########################################
 ############### PREDICTION ################
 ###########################################
@@ -103,6 +130,11 @@ eval_model = 'checkpoints/xyz.pt' #does nothing if auto_select is true
 preds_train = 'preds_train' #where to put the training prediction csv files
 preds_val = 'preds_val' #where to put the validation prediction csv files
 preds_test = 'preds_test' #where to put the testing prediction csv files
+use_prediction_cache = True #reuse softmax outputs for windows a checkpoint has already predicted
+prediction_cache = os.environ.get('PREDICTION_CACHE', 'prediction_cache/predictions.sqlite') #where the cache lives, shared by every run and by Accuracy Testing when PREDICTION_CACHE points both at one file
+prediction_cache_mb = 2000 #least recently used predictions are dropped beyond this size
+prediction_format = 'npz' #'npz' keeps coordinates and the full softmax of every window, 'csv' writes x,y,prediction,confidence
+predict_from_slides = False #cut windows straight from wsi_val and wsi_test instead of reading patches_eval_val and patches_eval_test
 
 ###########################################
 ############### EVALUATION ################
@@ -110,6 +142,7 @@ preds_test = 'preds_test' #where to put the testing prediction csv files
 
 #find the best threshold for filtering noise (discard patches with a confidence less than this threshold)
 threshold_search = [0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+per_class_threshold_search = False #try every combination of a threshold for each class, instead of one threshold for all classes
 
 #folder for outputing wsi predictions based on each threshold
 inference_train = 'inference_train'
@@ -121,6 +154,9 @@ colors = ['red', 'white', 'blue', 'green', 'purple', 'orange', 'black', 'pink',
 vis_train = 'vis_train'
 vis_val = 'vis_val'
 vis_test = 'vis_test'
+vis_downsample = 8 #the visualizations are this many times smaller than the whole slides
+vis_thumbnail = True #draw the predictions on a thumbnail of the slide, otherwise on a white background
+vis_alpha = 0.6 #opacity of the predictions at full confidence
 
 
 
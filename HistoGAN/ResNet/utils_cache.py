@@ -0,0 +1,76 @@
+# DeepSlide
+# Jason Wei, Behnaz Abdollahi, Saeed Hassanpour
+
+# Caching softmax predictions on disk by model checkpoint and patch content.
+# Also imported by the Accuracy Testing scripts, so this file only depends on the standard library and numpy.
+
+import os
+import math
+import time
+import hashlib
+import sqlite3
+import numpy as np
+
+###########################################
+############ PREDICTION CACHE #############
+###########################################
+
+#digest of a file's content, computed in chunks
+def file_digest(path):
+	digest = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1024*1024), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+#short digest of a patch, from its stored jpeg bytes, or the bytes of its input tensor for windows cut straight from a slide
+#a patch file keyed here and in Accuracy Testing gets the same key for the same checkpoint
+def content_digest(content):
+	return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+#softmax vectors in a sqlite file, keyed by checkpoint digest and patch digest
+#once the cache grows past max_size_mb, the least recently used predictions are dropped
+class PredictionCache():
+	def __init__(self, path, max_size_mb):
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.connection = sqlite3.connect(path)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, probs BLOB, last_used REAL)')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+		self.max_size = max_size_mb * 1000 * 1000
+
+	def key(self, model_digest, patch_digest):
+		return model_digest + ':' + patch_digest
+
+	#cached softmax vectors for the keys that are present, as a dictionary from key to float32 array
+	def get_many(self, keys):
+		key_to_probs = {}
+		for i in range(0, len(keys), 500): #sqlite limits the number of query parameters
+			chunk = keys[i:i+500]
+			rows = self.connection.execute('SELECT key, probs FROM predictions WHERE key IN ({})'.format(','.join('?' * len(chunk))), chunk).fetchall()
+			for key, probs in rows:
+				key_to_probs[key] = np.frombuffer(probs, dtype=np.float32)
+		if len(key_to_probs) > 0:
+			now = time.time()
+			self.connection.executemany('UPDATE predictions SET last_used = ? WHERE key = ?', [(now, key) for key in key_to_probs])
+			self.connection.commit()
+		return key_to_probs
+
+	def put_many(self, keys, probs):
+		now = time.time()
+		self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)', [(key, np.asarray(row, dtype=np.float32).tobytes(), now) for key, row in zip(keys, probs)])
+		self.connection.commit()
+		self.evict()
+
+	#drop the least recently used predictions until the cache is back under 90% of its size cap
+	def evict(self):
+		total_size, num_rows = self.connection.execute('SELECT SUM(LENGTH(key) + LENGTH(probs)), COUNT(*) FROM predictions').fetchone()
+		if num_rows == 0 or total_size <= self.max_size:
+			return
+		row_size = total_size / num_rows
+		num_evicted = int(math.ceil((total_size - 0.9 * self.max_size) / row_size))
+		self.connection.execute('DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_used LIMIT ?)', (num_evicted,))
+		self.connection.commit()
+
+	def close(self):
+		self.connection.close()
@@ -6,11 +6,13 @@
 
 import config
 from utils import *
+from utils_predictions import get_prediction_paths, prediction_path_to_slide, read_predictions
 
 from sklearn.metrics import recall_score
 from sklearn.metrics import precision_score
 from sklearn.metrics import confusion_matrix
 import operator
+import itertools
 from sklearn.metrics import cohen_kappa_score, f1_score, accuracy_score
 
 
@@ -30,17 +32,13 @@ from skimage.transform import rescale, rotate
 #get a prediction for a single whole slide
 def get_prediction(patches_pred_file, conf_thresholds):
 
-	classes = list(conf_thresholds.keys())
-	class_to_count = {_class:0 for _class in classes} #predicted class distribution per slide
-
-	#looping through all the lines in the file and adding predictions
-	patches_pred_lines = open(patches_pred_file, 'r').readlines()[1:]
-	for line in patches_pred_lines:
-		line_items = line[:-1].split(',')
-		line_class = line_items[2]
-		line_conf = float(line_items[3])
-		if line_class in classes and line_conf > conf_thresholds[line_class]:
-			class_to_count[line_class] += 1
+	#predicted class distribution per slide, counting only windows above the threshold of their class
+	predictions = read_predictions(patches_pred_file)
+	class_thresholds = np.array([conf_thresholds.get(_class, np.inf) for _class in config.classes])
+	known = predictions['class_num'] >= 0
+	class_nums, confidences = predictions['class_num'][known], predictions['confidence'][known]
+	counts = np.bincount(class_nums[confidences > class_thresholds[class_nums]], minlength=config.num_classes)
+	class_to_count = {_class: int(counts[i]) for i, _class in enumerate(config.classes)}
 
 	if sum(class_to_count.values()) > 0:
 		class_to_percent = {_class:class_to_count[_class]/sum(class_to_count.values()) for _class in class_to_count}
@@ -56,7 +54,7 @@ def get_prediction(patches_pred_file, conf_thresholds):
 	count_line = ','.join(counts_percent) + ',' + ','.join(counts_num)
 
 	#creating the line for output to csv
-	line = patches_pred_file.split('/')[-1].replace("csv", "jpg") + ',' + predicted_class + ',' + count_line
+	line = prediction_path_to_slide(patches_pred_file) + ',' + predicted_class + ',' + count_line
 
 	return line
 
@@ -77,19 +75,87 @@ def output_all_predictions(patches_pred_folder, output_folder, conf_thresholds):
 	line = ','.join(percent_header) + ',' + ','.join(count_header) + '\n'
 	writer.write(line)
 
-	csv_paths = get_csv_paths(patches_pred_folder)
-	for csv_path in csv_paths:
-		writer.write(get_prediction(csv_path, conf_thresholds)+'\n')
+	for prediction_path in get_prediction_paths(patches_pred_folder):
+		writer.write(get_prediction(prediction_path, conf_thresholds)+'\n')
 
 	writer.close()
 
+#load the window predictions of every whole slide once
+#returns a dictionary from slide name to (class number of each window, confidence of each window)
+def load_slide_predictions(patches_pred_folder):
+
+	slide_to_predictions = {}
+
+	for prediction_path in get_prediction_paths(patches_pred_folder):
+		predictions = read_predictions(prediction_path)
+		slide_to_predictions[prediction_path_to_slide(prediction_path)] = (predictions['class_num'], predictions['confidence'])
+
+	return slide_to_predictions
+
+#number of windows of each class with a confidence above each threshold, shape (num classes, num thresholds)
+def count_above_thresholds(class_nums, confidences, thresholds):
+	counts = np.zeros((config.num_classes, len(thresholds)), dtype=np.int64)
+	for class_num in range(config.num_classes):
+		class_confidences = np.sort(confidences[class_nums == class_num])
+		counts[class_num] = len(class_confidences) - np.searchsorted(class_confidences, thresholds, side='right')
+	return counts
+
+#average class accuracy of many threshold combinations at once
+#counts is (num slides, num classes, num thresholds), combinations is (num combinations, num classes) of threshold indices
+def score_threshold_combinations(counts, gt_class_nums, combinations):
+
+	#per slide class counts under each combination, shape (num slides, num combinations, num classes)
+	combination_counts = counts[:, np.arange(counts.shape[1])[None, :], combinations]
+	predicted_class_nums = np.argmax(combination_counts, axis=2) #ties go to the first class, like get_prediction
+	correct = predicted_class_nums == gt_class_nums[:, None]
+
+	class_accs = [correct[gt_class_nums == class_num].mean(axis=0) for class_num in np.unique(gt_class_nums)]
+	return np.mean(class_accs, axis=0)
+
+#find the confidence thresholds with the best average class accuracy, with every slide's predictions loaded once
+#if per_class, every combination of a threshold for each class is tried, otherwise one threshold for all classes
+def search_thresholds(slide_to_predictions, gt_labels, threshold_search, per_class=False):
+
+	thresholds = np.array(sorted(threshold_search), dtype=np.float64)
+	slides = sorted(slide for slide in slide_to_predictions if slide in gt_labels)
+	class_to_class_num = {_class: i for i, _class in enumerate(config.classes)}
+	gt_class_nums = np.array([class_to_class_num[gt_labels[slide]] for slide in slides])
+	counts = np.stack([count_above_thresholds(*slide_to_predictions[slide], thresholds) for slide in slides])
+
+	if per_class:
+		all_combinations = itertools.product(range(len(thresholds)), repeat=config.num_classes)
+	else:
+		all_combinations = ([i] * config.num_classes for i in range(len(thresholds)))
+
+	#score the combinations in chunks so memory stays bounded
+	chunk_size = max(1, 1000000 // max(1, len(slides) * config.num_classes))
+	best_acc, best_combination = -1, None
+	while True:
+		combinations = np.array(list(itertools.islice(all_combinations, chunk_size)), dtype=np.int64).reshape(-1, config.num_classes)
+		if combinations.shape[0] == 0:
+			break
+		avg_class_accs = score_threshold_combinations(counts, gt_class_nums, combinations)
+		if not per_class:
+			for combination, avg_class_acc in zip(combinations, avg_class_accs):
+				print('threshold', thresholds[combination[0]], 'has average class accuracy', str(avg_class_acc)[:5])
+		if avg_class_accs.max() > best_acc:
+			best_acc = avg_class_accs.max()
+			best_combination = combinations[np.argmax(avg_class_accs)]
+
+	best_thresholds = {_class: float(thresholds[best_combination[i]]) for i, _class in enumerate(config.classes)}
+	return best_thresholds, best_acc
+
 #main function for performing the grid search
-#first output predictions for each threshold
+#all thresholds are scored in memory, then only the predictions of the best thresholds are written out
 def grid_search(threshold_search, pred_folder, inference_folder, labels_csv):
 
-	for threshold in threshold_search:
-		conf_thresholds = {_class: threshold for _class in config.classes}
-		output_all_predictions(pred_folder, inference_folder, conf_thresholds)
+	slide_to_predictions = load_slide_predictions(pred_folder)
+	gt_labels = create_labels(labels_csv)
+	best_thresholds, best_acc = search_thresholds(slide_to_predictions, gt_labels, threshold_search, config.per_class_threshold_search)
+	print('best thresholds', best_thresholds, 'have average class accuracy', str(best_acc)[:5])
+
+	output_all_predictions(pred_folder, inference_folder, best_thresholds)
+	return best_thresholds
 
 ###########################################
 ######## FINDING BEST THRESHOLDS ##########
@@ -229,53 +295,109 @@ def add_predictions_to_image(xy_to_pred_class, image, prediction_to_color):
 #get the dictionary of predictions
 def get_xy_to_pred_class(window_prediction_folder, img_name):
 
+	slide_to_path = {file_no_extension(basename(path)): path for path in get_prediction_paths(window_prediction_folder)}
+	predictions = read_predictions(slide_to_path[img_name.split('.')[0]])
+
+	#implement thresholding
 	xy_to_pred_class = {}
+	for x, y, class_num, confidence in zip(predictions['x'], predictions['y'], predictions['class_num'], predictions['confidence']):
+		if class_num >= 0:
+			xy_to_pred_class[(x, y)] = (config.classes[class_num], confidence)
 
-	csv_file = join(window_prediction_folder, img_name.split('.')[0]) + ".csv"
-	csv_lines = open(csv_file, 'r').readlines()[1:]
-	predictions = [line[:-1].split(',') for line in csv_lines]
+	return(xy_to_pred_class)
 
-	for prediction in predictions: 
-		x = prediction[0]
-		y = prediction[1]
-		pred_class = prediction[2]
-		confidence = float(prediction[3])
 
-		#implement thresholding
-		xy_to_pred_class[(x, y)] = (pred_class, confidence)
 
-	return(xy_to_pred_class)
+#height and width of a whole slide, without decoding it
+def get_slide_size(slide_path):
+	if slide_path.endswith('.npy'):
+		return np.load(slide_path, mmap_mode='r').shape[:2]
+	width, height = Image.open(slide_path).size
+	return height, width
+
+#rgb thumbnail of a whole slide, downsampled by an integer factor
+#jpegs are decoded straight at a reduced scale and .npy slides (bgr, like cv2) are read in bands, so the full slide never sits in memory
+def read_thumbnail(slide_path, downsample, band_rows=256):
+
+	height, width = get_slide_size(slide_path)
+	thumbnail_height, thumbnail_width = -(-height // downsample), -(-width // downsample)
+
+	if slide_path.endswith('.npy'):
+		image = np.load(slide_path, mmap_mode='r')
+		thumbnail = np.zeros((thumbnail_height, thumbnail_width, 3), dtype=np.uint8)
+		for row in range(0, thumbnail_height, band_rows):
+			thumbnail[row:row+band_rows] = image[row*downsample:(row+band_rows)*downsample:downsample, ::downsample, ::-1]
+		return thumbnail
+
+	image = Image.open(slide_path)
+	image.draft('RGB', (thumbnail_width, thumbnail_height)) #only has an effect on jpegs
+	return np.asarray(image.convert('RGB').resize((thumbnail_width, thumbnail_height), Image.BILINEAR))
+
+#paint every window prediction as a square of its class color onto a thumbnail sized overlay, all windows at once
+#returns the overlay colors and the opacity of each pixel, which is the confidence of the prediction
+def render_prediction_overlay(predictions, overlay_shape, downsample, class_num_to_color, cell_size):
+
+	overlay = np.zeros(overlay_shape[:2] + (3,), dtype=np.uint8)
+	opacity = np.zeros(overlay_shape[:2], dtype=np.float32)
+
+	known = predictions['class_num'] >= 0
+	class_nums, confidences = predictions['class_num'][known], predictions['confidence'][known]
+
+	#each window covers the cell_size square around its center, which is one step of the sliding window
+	offset = config.patch_size // 2 - cell_size // 2
+	rows = (predictions['x'][known] + offset) // downsample
+	cols = (predictions['y'][known] + offset) // downsample
+	cell_pixels = max(1, cell_size // downsample)
 
+	for row_offset in range(cell_pixels):
+		for col_offset in range(cell_pixels):
+			cell_rows = np.clip(rows + row_offset, 0, overlay_shape[0] - 1)
+			cell_cols = np.clip(cols + col_offset, 0, overlay_shape[1] - 1)
+			overlay[cell_rows, cell_cols] = class_num_to_color[class_nums]
+			opacity[cell_rows, cell_cols] = confidences
 
+	return overlay, opacity
 
 #main function for visualization
+#draws a downsampled heatmap of the window predictions, optionally on a thumbnail of the slide
 def visualize(wsi_folder, preds_folder, vis_folder, colors):
 
 	#get list of whole slides
 	whole_slides = get_all_image_paths(wsi_folder)
 	print(len(whole_slides), "whole slides found from", wsi_folder)
 
-	prediction_to_color = {config.classes[i]:color_to_np_color(config.colors[i]) for i in range(config.num_classes)}
+	class_num_to_color = np.array([color_to_np_color(colors[i]) for i in range(config.num_classes)], dtype=np.uint8)
+	slide_to_prediction_path = {file_no_extension(basename(path)): path for path in get_prediction_paths(preds_folder)}
+	downsample = config.vis_downsample
+	cell_size = int(config.patch_size / config.slide_overlap)
 
 	#for each wsi
 	for whole_slide in whole_slides:
 
-		#read in the image
-		whole_slide_numpy = cv2.imread(whole_slide); print("visualizing", whole_slide, "of shape", whole_slide_numpy.shape); assert whole_slide_numpy.shape[2] == 3
-		
-		#get the predictions
-		xy_to_pred_class = get_xy_to_pred_class(preds_folder, whole_slide.split('/')[-1])
-		
-		#add the predictions to image
-		whole_slide_with_predictions = add_predictions_to_image(xy_to_pred_class, whole_slide_numpy, prediction_to_color)
-		
+		slide = whole_slide.split('/')[-1].split('.')[0]
+		if slide not in slide_to_prediction_path:
+			print("no predictions for", whole_slide)
+			continue
+
+		#the background, either a thumbnail of the slide or white
+		if config.vis_thumbnail:
+			image = read_thumbnail(whole_slide, downsample)
+		else:
+			height, width = get_slide_size(whole_slide)
+			image = np.full((-(-height // downsample), -(-width // downsample), 3), 255, dtype=np.uint8)
+		print("visualizing", whole_slide, "at", image.shape, "downsampled by", downsample)
+
+		#add the predictions to image, blending one band of rows at a time
+		predictions = read_predictions(slide_to_prediction_path[slide])
+		overlay, opacity = render_prediction_overlay(predictions, image.shape, downsample, class_num_to_color, cell_size)
+		opacity *= config.vis_alpha
+		for row in range(0, image.shape[0], 256):
+			band_opacity = opacity[row:row+256, :, None]
+			image[row:row+256] = (image[row:row+256] * (1 - band_opacity) + overlay[row:row+256] * band_opacity).astype(np.uint8)
+
 		#save it
-		output_path = join(vis_folder, whole_slide.split('/')[-1].split('.')[0]+'_predictions.jpg')
+		output_path = join(vis_folder, slide+'_predictions.jpg')
 		confirm_output_folder(basefolder(output_path))
-		imsave(output_path, whole_slide_with_predictions)
+		Image.fromarray(image).save(output_path, quality=90)
 
 	print('find the visualizations in', vis_folder)
-
-
-
-
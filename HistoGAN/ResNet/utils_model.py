@@ -5,6 +5,10 @@
 
 import config
 from utils import *
+from utils_shards import ShardDataset, ShardShuffleSampler, get_slide_datasets
+from utils_processing import get_window_starts, is_purple_windows
+from utils_predictions import write_predictions, write_predictions_csv
+from utils_cache import PredictionCache, file_digest, content_digest
 
 import torch
 import torch.nn as nn
@@ -12,46 +16,49 @@ import torch.optim as optim
 from torch.optim import lr_scheduler
 import torchvision
 from torchvision import datasets, models, transforms
+import io
 import copy
 import time
 import random
-from sklearn.metrics import confusion_matrix
+import cv2
+from PIL import Image
 import operator
+import collections
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 ###########################################
 ############# MISC FUNCTIONS ##############
 ###########################################
 
-#computing the confusion matrix
-def update_confusion_matrix(all_labels, all_predicts, batch_labels, batch_predicts, num_classes):
-
-    if all_labels is not None:
-        assert all_labels.shape[0] == all_predicts.shape[0]
-        if all_labels.shape[0] > 10000:
-            all_labels = all_labels[-10000:]
-            all_predicts = all_predicts[-10000:]
-
-    if all_labels is None and all_predicts is None:
-        all_labels = batch_labels
-        all_predicts = batch_predicts
-    elif all_labels is not None and all_predicts is not None:
-        all_labels = torch.cat((all_labels, batch_labels))
-        all_predicts = torch.cat((all_predicts, batch_predicts))
-
-    conf_matrix = confusion_matrix(all_labels, all_predicts, labels=list(range(num_classes)))
-
-    probs_matrix = np.zeros(conf_matrix.shape)
-
-    for i in range(probs_matrix.shape[0]):
-        row = conf_matrix[i]
-        if np.sum(row) == 0:
-            probs_row = 0
-        else:
-            probs_row = row/np.sum(row)
-        probs_matrix[i] = probs_row
-
-    probs_matrix = np.around(probs_matrix, decimals=5)
-    return probs_matrix, all_labels, all_predicts
+#confusion matrix kept as a count tensor on the device, updated with one bincount per batch
+#if window is set, only roughly the last window samples are counted, as a deque of per batch counts
+class ConfusionMatrix():
+    def __init__(self, num_classes, device, window=None):
+        self.num_classes = num_classes
+        self.window = window
+        self.counts = torch.zeros(num_classes * num_classes, dtype=torch.long, device=device)
+        self.batch_counts = collections.deque()
+        self.num_samples = 0
+
+    def update(self, batch_labels, batch_predicts):
+        batch_count = torch.bincount(batch_labels * self.num_classes + batch_predicts, minlength=self.num_classes * self.num_classes)
+        self.counts += batch_count
+        if self.window is not None:
+            self.batch_counts.append((batch_count, batch_labels.shape[0]))
+            self.num_samples += batch_labels.shape[0]
+            #drop the oldest batches, but always keep at least window samples
+            while self.num_samples - self.batch_counts[0][1] >= self.window:
+                old_count, old_num_samples = self.batch_counts.popleft()
+                self.counts -= old_count
+                self.num_samples -= old_num_samples
+
+    #rows normalized to sum to one, as a numpy array
+    def get_probs_matrix(self):
+        conf_matrix = self.counts.view(self.num_classes, self.num_classes).cpu().numpy().astype(np.float64)
+        row_sums = conf_matrix.sum(axis=1, keepdims=True)
+        probs_matrix = np.divide(conf_matrix, row_sums, out=np.zeros_like(conf_matrix), where=row_sums > 0)
+        return np.around(probs_matrix, decimals=5)
 
 #printing the confusion matrix during training
 def print_conf_matrix(confusion_matrix, classes):
@@ -61,6 +68,11 @@ def print_conf_matrix(confusion_matrix, classes):
         row_pretty = '{:3s}'.format(_class) + " ".join(['{:.3f}'.format(number) for number in row])
         print(row_pretty)
 
+#printing how long a phase waited on the dataloader versus the model
+def print_data_wait(phase, data_time, compute_time):
+    total_time = max(data_time + compute_time, 1e-9)
+    print('{} data wait: {:.1f}s, compute: {:.1f}s ({:.1f}% waiting on data)'.format(phase, data_time, compute_time, 100 * data_time / total_time))
+
 #random rotation function
 #credits to Naofumi Tomita
 class Random90Rotation():
@@ -71,6 +83,174 @@ class Random90Rotation():
         degree = random.sample(self.degrees, k=1)[0]
         return im.rotate(degree)
 
+#balances classes at load time instead of duplicating images on disk
+#every epoch, each class is drawn num_per_class times: all of its images cycled as often as they fit, then a random rest
+#if groups (e.g. the shard of each image) are given, the drawn images are visited group by group to keep reads local
+class ClassBalancedSampler(torch.utils.data.Sampler):
+    def __init__(self, targets, num_per_class, groups=None):
+        self.class_to_indices = {}
+        for idx, target in enumerate(targets):
+            self.class_to_indices.setdefault(target, []).append(idx)
+        self.num_per_class = num_per_class
+        self.groups = groups
+
+    def __iter__(self):
+        indices = []
+        for class_indices in self.class_to_indices.values():
+            num_rounds, num_rest = divmod(self.num_per_class, len(class_indices))
+            indices += class_indices * num_rounds + random.sample(class_indices, num_rest)
+        random.shuffle(indices)
+        if self.groups is not None:
+            group_order = list(set(self.groups[idx] for idx in indices))
+            random.shuffle(group_order)
+            group_rank = {group: rank for rank, group in enumerate(group_order)}
+            indices.sort(key=lambda idx: group_rank[self.groups[idx]]) #stable, so still shuffled within each group
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_per_class * len(self.class_to_indices)
+
+#the sliding windows of one wsi, cut on the fly instead of being written to disk by gen_patches_by_folder
+#returns (window, (x, y)) pairs, windows are in the same order and bgr channel order as the generated patches
+#a slide saved as .npy is memory mapped instead of decoded
+class SlideWindowDataset(torch.utils.data.Dataset):
+    def __init__(self, slide_path, patch_size, inverse_overlap_factor, transform=None, tissue_filter=config.type_histopath):
+        if slide_path.endswith('.npy'):
+            self.image = np.load(slide_path, mmap_mode='r')
+        else:
+            self.image = cv2.imread(slide_path)
+        self.patch_size = patch_size
+        self.transform = transform
+        self.coordinates = []
+
+        x_max, y_max = self.image.shape[0], self.image.shape[1]
+        if x_max < patch_size or y_max < patch_size:
+            print(slide_path, 'of size', x_max, 'by', y_max, "is too small")
+            return
+
+        #keep only the windows with tissue in them
+        x_starts, y_starts = get_window_starts(x_max, y_max, inverse_overlap_factor)
+        if tissue_filter:
+            keep = is_purple_windows(self.image, x_starts, y_starts, patch_size)
+        else:
+            keep = np.ones((len(x_starts), len(y_starts)), dtype=bool)
+        self.coordinates = [(x_starts[i], y_starts[j]) for i, j in zip(*np.nonzero(keep))]
+
+    def __len__(self):
+        return len(self.coordinates)
+
+    def __getitem__(self, idx):
+        x, y = self.coordinates[idx]
+        window = Image.fromarray(np.ascontiguousarray(self.image[x:x+self.patch_size, y:y+self.patch_size, :]))
+        if self.transform is not None:
+            window = self.transform(window)
+        return window, (x, y)
+
+    #x and y coordinates of every window, in dataset order
+    def get_coordinates(self):
+        return self.coordinates
+
+#windows of many slides as one stream, each worker process cutting whole slides in turn
+#returns (window, slide number, x, y, number of windows in the slide) so that predictions can be sorted back by slide
+class SlideStreamDataset(torch.utils.data.IterableDataset):
+    def __init__(self, slide_paths, patch_size, inverse_overlap_factor, transform=None, tissue_filter=config.type_histopath):
+        self.slide_paths = slide_paths
+        self.patch_size = patch_size
+        self.inverse_overlap_factor = inverse_overlap_factor
+        self.transform = transform
+        self.tissue_filter = tissue_filter
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        for slide_num in range(worker_id, len(self.slide_paths), num_workers):
+            slide_dataset = SlideWindowDataset(self.slide_paths[slide_num], self.patch_size, self.inverse_overlap_factor, self.transform, self.tissue_filter)
+            for idx in range(len(slide_dataset)):
+                window, (x, y) = slide_dataset[idx]
+                yield window, slide_num, x, y, len(slide_dataset)
+
+#the windows of one slide from a dataset of patches, tagged like SlideStreamDataset so many slides can be concatenated
+#with_digests also returns the content digest of each window, read from the same bytes that are decoded,
+#so that the dataloader workers hash the windows for the prediction cache and each window is read only once
+class TaggedSlideDataset(torch.utils.data.Dataset):
+    def __init__(self, dataset, slide_num, coordinates, with_digests=False):
+        assert len(dataset) == len(coordinates)
+        self.dataset = dataset
+        self.slide_num = slide_num
+        self.coordinates = coordinates
+        self.with_digests = with_digests
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        x, y = self.coordinates[idx]
+        if not self.with_digests:
+            return self.dataset[idx][0], self.slide_num, x, y, len(self.dataset)
+        content = self.read_bytes(idx)
+        image = Image.open(io.BytesIO(content)).convert('RGB')
+        if self.dataset.transform is not None:
+            image = self.dataset.transform(image)
+        return image, self.slide_num, x, y, len(self.dataset), content_digest(content)
+
+    #the stored bytes of a window, a jpeg file of an ImageFolder or a record of a ShardDataset, without decoding them
+    def read_bytes(self, idx):
+        if isinstance(self.dataset, ShardDataset):
+            return self.dataset.read_bytes(idx)
+        with open(self.dataset.samples[idx][0], 'rb') as f:
+            return f.read()
+
+#turns a pil image into a uint8 tensor, so that batches can be augmented after collation
+class ToUint8Tensor():
+    def __call__(self, im):
+        return torch.from_numpy(np.array(im, dtype=np.uint8)).permute(2, 0, 1).contiguous()
+
+#the training augmentation on a whole uint8 batch at once, on the device
+#random flips, 90 degree rotations and brightness/contrast/saturation jitter for each image, then normalization
+class BatchAugment():
+    def __init__(self, mean, std, brightness=0.5, contrast=0.5, saturation=0.5):
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.gray_weights = torch.tensor([0.299, 0.587, 0.114]).view(1, 3, 1, 1)
+
+    #one random factor in [1-amount, 1+amount] per image
+    def random_factors(self, batch, amount):
+        return torch.empty(batch.shape[0], 1, 1, 1, device=batch.device).uniform_(1 - amount, 1 + amount)
+
+    def __call__(self, batch):
+        batch = batch.float() / 255
+        num_images = batch.shape[0]
+
+        #flips and rotations
+        for dim in [2, 3]:
+            flip = torch.rand(num_images, device=batch.device) < 0.5
+            batch[flip] = batch[flip].flip(dim)
+        num_rotations = torch.randint(0, 4, (num_images,), device=batch.device)
+        for k in [1, 2, 3]:
+            rotate = num_rotations == k
+            batch[rotate] = torch.rot90(batch[rotate], k, (2, 3))
+
+        #color jitter
+        gray_weights = self.gray_weights.to(batch.device)
+        batch = (batch * self.random_factors(batch, self.brightness)).clamp_(0, 1)
+        mean_gray = (batch * gray_weights).sum(dim=1, keepdim=True).mean(dim=(2, 3), keepdim=True)
+        batch = ((batch - mean_gray) * self.random_factors(batch, self.contrast) + mean_gray).clamp_(0, 1)
+        gray = (batch * gray_weights).sum(dim=1, keepdim=True)
+        batch = ((batch - gray) * self.random_factors(batch, self.saturation) + gray).clamp_(0, 1)
+
+        return (batch - self.mean.to(batch.device)) / self.std.to(batch.device)
+
+#keyword arguments for every dataloader, from config
+def get_dataloader_kwargs(persistent_workers=config.persistent_workers):
+    kwargs = {'num_workers': config.num_workers, 'pin_memory': config.pin_memory}
+    if config.num_workers > 0: #only valid with worker processes
+        kwargs['persistent_workers'] = persistent_workers
+        kwargs['prefetch_factor'] = config.prefetch_factor
+    return kwargs
+
 #instantiate the model
 def create_model(num_layers, pretrain):
 
@@ -156,85 +336,195 @@ def print_params(train_folder, num_epochs, num_layers,
 	print()
 
 
+###########################################
+############### CHECKPOINTS ###############
+###########################################
+
+#copy every tensor in a (nested) state dict to the cpu, so it can be written while training goes on
+def state_to_cpu(state):
+    if torch.is_tensor(state):
+        return state.detach().cpu().clone()
+    if isinstance(state, dict):
+        return {key: state_to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(value) for value in state)
+    return copy.deepcopy(state)
+
+#saves state dicts on a background thread and keeps only the top k checkpoints by validation accuracy
+#every kept checkpoint and its metrics are listed in checkpoints.json, so the best one is found without loading any
+class CheckpointManager():
+    def __init__(self, checkpoints_folder, keep_top_k=config.keep_top_k):
+        confirm_output_folder(checkpoints_folder)
+        self.index_path = join(checkpoints_folder, 'checkpoints.json')
+        self.checkpoints_folder = checkpoints_folder
+        self.keep_top_k = keep_top_k
+        self.index = read_checkpoint_index(checkpoints_folder)
+        self.executor = ThreadPoolExecutor(max_workers=1) #one writer, so checkpoints are written in order
+        self.pending = None
+
+    def save(self, model, optimizer, scheduler, epoch, metrics):
+        checkpoint_path = join(self.checkpoints_folder, "resnet" + str(config.num_layers) + "_e" + str(epoch) + "_va" + str(float(metrics['val_acc']))[:5] + ".pt")
+        checkpoint = {  'num_layers': config.num_layers,
+                        'num_classes': config.num_classes,
+                        'epoch': epoch,
+                        'metrics': metrics,
+                        'model_state_dict': state_to_cpu(model.state_dict()),
+                        'optimizer_state_dict': state_to_cpu(optimizer.state_dict()),
+                        'scheduler_state_dict': state_to_cpu(scheduler.state_dict())}
+        self.wait()
+        self.pending = self.executor.submit(self._write, checkpoint, checkpoint_path)
+
+    def _write(self, checkpoint, checkpoint_path):
+        torch.save(checkpoint, checkpoint_path + '.tmp')
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        #keep the best k, delete the rest
+        self.index = [entry for entry in self.index if entry['path'] != checkpoint_path]
+        self.index.append(dict(checkpoint['metrics'], path=checkpoint_path, epoch=checkpoint['epoch']))
+        self.index.sort(key=lambda entry: entry['val_acc'], reverse=True)
+        if self.keep_top_k is not None:
+            for entry in self.index[self.keep_top_k:]:
+                if os.path.exists(entry['path']):
+                    os.remove(entry['path'])
+            self.index = self.index[:self.keep_top_k]
+
+        with open(self.index_path + '.tmp', 'w') as index_file:
+            json.dump(self.index, index_file, indent=2)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    #block until the last checkpoint is on disk
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+#list of {path, epoch, val_acc, ...} for the kept checkpoints, best first
+def read_checkpoint_index(checkpoints_folder):
+    index_path = join(checkpoints_folder, 'checkpoints.json')
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, 'r') as index_file:
+        return json.load(index_file)
+
+#load a model from a state dict checkpoint, or from a whole pickled model saved by older versions
+#returns the model and the checkpoint dictionary (None for a pickled model)
+def load_checkpoint(checkpoint_path, device):
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    if isinstance(checkpoint, dict) and 'model_state_dict' in checkpoint:
+        model = create_model(checkpoint['num_layers'], pretrain=False)
+        model.load_state_dict(checkpoint['model_state_dict'])
+        return model.to(device), checkpoint
+    return checkpoint.to(device), None
+
 ###########################################
 ########## MAIN TRAIN FUNCTION ############
 ###########################################
 
 #helper function for training resnet
-def train_helper(model, dataloaders, device, dataset_sizes, criterion, optimizer, scheduler, num_epochs, save_interval, writer):
+#if batch_augment is given, training batches come in as uint8 and are augmented and normalized on the device
+def train_helper(model, dataloaders, device, dataset_sizes, criterion, optimizer, scheduler, num_epochs, save_interval, writer, batch_augment=None):
 
     since = time.time()
+    checkpoint_manager = CheckpointManager(config.checkpoints_folder)
+
+    #opt-in fast path: bfloat16 autocast (on the cpu or gpu) and channels last inputs to match a channels last model
+    memory_format = torch.channels_last if config.channels_last else torch.contiguous_format
 
     #each epoch
     for epoch in range(num_epochs):
+        epoch_start = time.time()
 
         ############### training phase ###############
         phase = 'train'
         model.train()
 
-        train_running_loss = 0.0
-        train_running_corrects = 0
-        train_conf_matrix = None
-        train_all_labels = None
-        train_all_predicts = None
+        #kept on the device and only read once per epoch, so that steps never wait on each other
+        train_running_loss = torch.zeros((), device=device)
+        train_running_corrects = torch.zeros((), dtype=torch.long, device=device)
+        train_conf_matrix = ConfusionMatrix(config.num_classes, device, config.conf_matrix_window)
+
+        #time spent waiting for batches versus computing on them
+        train_data_time, train_compute_time = 0.0, 0.0
+        batch_start = time.time()
 
         #train over all training data
         for inputs, labels in dataloaders['train']:
-            train_inputs = inputs.to(device)
-            train_labels = labels.to(device)
+            batch_loaded = time.time()
+            train_data_time += batch_loaded - batch_start
+            train_inputs = inputs.to(device, non_blocking=config.pin_memory)
+            train_labels = labels.to(device, non_blocking=config.pin_memory)
+            if batch_augment is not None:
+                train_inputs = batch_augment(train_inputs)
+            train_inputs = train_inputs.contiguous(memory_format=memory_format)
             optimizer.zero_grad()
 
-            #forward and backprop
+            #forward and backprop, only the forward pass and loss run under autocast
             with torch.set_grad_enabled(phase == 'train'):
-                train_outputs = model(train_inputs)
-                _, train_preds = torch.max(train_outputs, 1)
-                train_loss = criterion(train_outputs, train_labels)
+                with torch.autocast(device.type, dtype=torch.bfloat16, enabled=config.mixed_precision):
+                    train_outputs = model(train_inputs)
+                    _, train_preds = torch.max(train_outputs, 1)
+                    train_loss = criterion(train_outputs, train_labels)
                 train_loss.backward()
                 optimizer.step()
                 optimizer.param_groups
 
             #update training diagnostics
-            train_running_loss += train_loss.item() * train_inputs.size(0)
+            train_running_loss += train_loss.detach() * train_inputs.size(0)
             train_running_corrects += torch.sum(train_preds == train_labels.data)
-            train_conf_matrix, train_all_labels, train_all_predicts = update_confusion_matrix(train_all_labels, train_all_predicts, train_labels.data, train_preds, config.num_classes)
+            train_conf_matrix.update(train_labels.data, train_preds)
+            batch_start = time.time()
+            train_compute_time += batch_start - batch_loaded
 
         #print training diagnostics
-        train_loss = train_running_loss / dataset_sizes['train']
-        train_acc = train_running_corrects.double() / dataset_sizes['train']
+        train_loss = train_running_loss.item() / dataset_sizes['train']
+        train_acc = train_running_corrects.item() / dataset_sizes['train']
+        train_time = time.time() - epoch_start
         print("training confusion matrix:")
-        print_conf_matrix(train_conf_matrix, config.classes)
+        print_conf_matrix(train_conf_matrix.get_probs_matrix(), config.classes)
+        print_data_wait('training', train_data_time, train_compute_time)
 
         ############### validation phase ###############
         phase = 'val'
         model.eval()
 
-        val_running_loss = 0.0
-        val_running_corrects = 0
-        val_conf_matrix = None
-        val_all_labels = None
-        val_all_predicts = None
+        val_running_loss = torch.zeros((), device=device)
+        val_running_corrects = torch.zeros((), dtype=torch.long, device=device)
+        val_conf_matrix = ConfusionMatrix(config.num_classes, device, config.conf_matrix_window)
+
+        val_data_time, val_compute_time = 0.0, 0.0
+        batch_start = time.time()
 
         #forward prop over all validation data
         for val_inputs, val_labels in dataloaders['val']:
-            val_inputs = val_inputs.to(device)
-            val_labels = val_labels.to(device)
+            batch_loaded = time.time()
+            val_data_time += batch_loaded - batch_start
+            val_inputs = val_inputs.to(device, non_blocking=config.pin_memory)
+            val_labels = val_labels.to(device, non_blocking=config.pin_memory)
+            val_inputs = val_inputs.contiguous(memory_format=memory_format)
 
             #forward
-            with torch.set_grad_enabled(phase == 'val'):
+            with torch.no_grad(), torch.autocast(device.type, dtype=torch.bfloat16, enabled=config.mixed_precision):
                 val_outputs = model(val_inputs)
                 _, val_preds = torch.max(val_outputs, 1)
                 val_loss = criterion(val_outputs, val_labels)
 
             #update validation diagnostics
-            val_running_loss += val_loss.item() * val_inputs.size(0)
+            val_running_loss += val_loss.detach() * val_inputs.size(0)
             val_running_corrects += torch.sum(val_preds == val_labels.data)
-            val_conf_matrix, val_all_labels, val_all_predicts = update_confusion_matrix(val_all_labels, val_all_predicts, val_labels.data, val_preds, config.num_classes)
+            val_conf_matrix.update(val_labels.data, val_preds)
+            batch_start = time.time()
+            val_compute_time += batch_start - batch_loaded
 
         #print validation diagnostics
-        val_loss = val_running_loss / dataset_sizes['val']
-        val_acc = val_running_corrects.double() / dataset_sizes['val']
+        val_loss = val_running_loss.item() / dataset_sizes['val']
+        val_acc = val_running_corrects.item() / dataset_sizes['val']
         print("validation confusion matrix:")
-        print_conf_matrix(val_conf_matrix, config.classes)
+        print_conf_matrix(val_conf_matrix.get_probs_matrix(), config.classes)
+        print_data_wait('validation', val_data_time, val_compute_time)
 
         #scheduler.step(val_loss) if you use decay on plateau
         scheduler.step()
@@ -244,17 +534,19 @@ def train_helper(model, dataloaders, device, dataset_sizes, criterion, optimizer
 
         #remaining things related to training
         if epoch % int(save_interval) == 0:
-            epoch_output_path = config.checkpoints_folder + "/resnet" + str(config.num_layers) + "_e" + str(epoch) + "_va" + str(float(val_acc))[:5] + ".pt"
-            confirm_output_folder(basefolder(epoch_output_path))
-            torch.save(model, epoch_output_path)
+            checkpoint_manager.save(model, optimizer, scheduler, epoch, {'train_loss': float(train_loss), 'train_acc': float(train_acc), 'val_loss': float(val_loss), 'val_acc': float(val_acc)})
 
-        writer.write('{},{:4f},{:4f},{:4f},{:4f}\n'.format(str(epoch), train_loss, train_acc, val_loss, val_acc))
+        epoch_time = time.time() - epoch_start
+        train_images_per_sec = dataset_sizes['train'] / max(train_time, 1e-9)
+        writer.write('{},{:4f},{:4f},{:4f},{:4f},{:.1f},{:.1f}\n'.format(str(epoch), train_loss, train_acc, val_loss, val_acc, epoch_time, train_images_per_sec))
+        writer.flush()
 
 		#remaining diagnostics
-        print('Epoch {} with lr {:.15f}: t_loss: {:.4f} t_acc: {:.4f} v_loss:{:.4f} v_acc: {:.4f}'.format(str(epoch), current_lr, train_loss, train_acc, val_loss, val_acc))
+        print('Epoch {} with lr {:.15f}: t_loss: {:.4f} t_acc: {:.4f} v_loss:{:.4f} v_acc: {:.4f} in {:.0f}s, {:.1f} train images/sec'.format(str(epoch), current_lr, train_loss, train_acc, val_loss, val_acc, epoch_time, train_images_per_sec))
         print()
 
     # at the end:
+    checkpoint_manager.close()
     print()
     time_elapsed = time.time() - since
     print('training complete in {:.0f} minutes'.format(time_elapsed // 60))
@@ -288,9 +580,32 @@ def train_resnet(train_folder, num_epochs, num_layers,
 	    ]),
 	}
 
-	image_datasets = {x: datasets.ImageFolder(os.path.join(config.train_folder, x), data_transforms[x]) for x in ['train', 'val']}
-	dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=batch_size, shuffle=x=='train', num_workers=4) for x in ['train', 'val']}
-	dataset_sizes = {x: len(image_datasets[x]) for x in ['train', 'val']}
+	#augment whole batches on the device instead of each image in the loader workers
+	batch_augment = None
+	if config.batch_augment:
+		data_transforms['train'] = transforms.Compose([
+		    transforms.CenterCrop(config.patch_size),
+		    ToUint8Tensor()
+		])
+		batch_augment = BatchAugment([0.7, 0.6, 0.7], [0.15, 0.15, 0.15])
+
+	if config.patch_store == 'shards':
+		image_datasets = {x: ShardDataset(os.path.join(config.train_folder, x), data_transforms[x], config.classes) for x in ['train', 'val']}
+	else:
+		image_datasets = {x: datasets.ImageFolder(os.path.join(config.train_folder, x), data_transforms[x]) for x in ['train', 'val']}
+
+	#how the training set is drawn each epoch
+	shards = [record[0] for record in image_datasets['train'].records] if config.patch_store == 'shards' else None
+	if config.virtual_balance: #balance the classes without any copies on disk
+		train_sampler = ClassBalancedSampler(image_datasets['train'].targets, config.num_train_per_class, shards)
+	elif config.patch_store == 'shards': #shuffled shard order so that each shard is read as a block
+		train_sampler = ShardShuffleSampler(image_datasets['train'])
+	else:
+		train_sampler = None
+	samplers = {'train': train_sampler, 'val': None}
+
+	dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=batch_size, shuffle=x=='train' and samplers[x] is None, sampler=samplers[x], **get_dataloader_kwargs()) for x in ['train', 'val']}
+	dataset_sizes = {x: len(samplers[x]) if samplers[x] is not None else len(image_datasets[x]) for x in ['train', 'val']}
 
 	print(len(config.classes), 'classes:', config.classes)
 	print('num train images', len(dataloaders['train'])*batch_size)
@@ -299,13 +614,16 @@ def train_resnet(train_folder, num_epochs, num_layers,
 	device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 	#initialize model
+	checkpoint = None
 	if resume_checkpoint == True:
-		model = torch.load(resume_checkpoint_path)
+		model, checkpoint = load_checkpoint(resume_checkpoint_path, device)
 		print('model loaded from', resume_checkpoint_path)
 	else:
 		model = create_model(num_layers, pretrain)
 
 	model = model.to(device) #same as model.cuda()
+	if config.channels_last:
+		model = model.to(memory_format=torch.channels_last)
 
 	#multi class cross entropy
 	criterion = nn.CrossEntropyLoss()
@@ -316,10 +634,15 @@ def train_resnet(train_folder, num_epochs, num_layers,
 	#learning rate: exponential, can also try scheduler = lr_scheduler.ReduceLROnPlateau(optimizer)
 	scheduler = lr_scheduler.ExponentialLR(optimizer, gamma=learning_rate_decay)
 
+	#carry on with the optimizer and learning rate of the checkpoint
+	if checkpoint is not None:
+		optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+		scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+
 	#logging the model after every epoch
 	confirm_output_folder(basefolder(log_csv))
 	writer = open(log_csv, 'w')
-	writer.write('epoch,train_loss,train_acc,val_loss,val_acc\n')
+	writer.write('epoch,train_loss,train_acc,val_loss,val_acc,epoch_time,train_images_per_sec\n')
 
 	#print
 	print_params(train_folder, num_epochs, num_layers, 
@@ -331,7 +654,7 @@ def train_resnet(train_folder, num_epochs, num_layers,
 
 
 	#train model
-	model = train_helper(model, dataloaders, device, dataset_sizes, criterion, optimizer, scheduler, num_epochs, save_interval, writer)
+	model = train_helper(model, dataloaders, device, dataset_sizes, criterion, optimizer, scheduler, num_epochs, save_interval, writer, batch_augment)
 
 
 
@@ -346,14 +669,81 @@ def parse_val_acc(model_path):
 	return val_acc
 
 #return the model with the best validation accuracy
+#read from checkpoints.json, or from the filenames of checkpoints saved by older versions
 def get_best_model(checkpoints_folder):
-	models = get_image_paths(checkpoints_folder)
+	checkpoint_index = read_checkpoint_index(checkpoints_folder)
+	if len(checkpoint_index) > 0:
+		return max(checkpoint_index, key=lambda entry: entry['val_acc'])['path']
+	models = [model for model in get_image_paths(checkpoints_folder) if model.endswith('.pt')]
 	model_to_val_acc = {model: parse_val_acc(model) for model in models}
 	best_model = max(model_to_val_acc.items(), key=operator.itemgetter(1))[0]
 	return best_model
 
+#run the model over one continuous stream of windows from many slides, with a single pool of loader workers
+#predictions are gathered per slide and each slide is written out as soon as all of its windows are predicted
+#if a prediction cache and the digest of the model checkpoint are given, only windows missing from the cache go through the model
+#windows of patch folders and shards are keyed by their stored bytes, so cached windows are never even decoded
+#windows cut straight from slides have no stored bytes, so they are keyed by the bytes of their input tensors
+#returns the number of slides and windows predicted
+def predict_slides(model, device, image_dataset, slides, output_folder, cache=None, model_digest=None):
+
+	slide_num_to_windows = {} #slide number to lists of x, y and softmax batches
+	counts = {'slides': 0, 'windows': 0, 'cached': 0}
+
+	#add predicted windows to their slides, writing out every slide that is complete
+	def add_windows(slide_nums, xs, ys, slide_sizes, probs):
+		for slide_num in np.unique(slide_nums):
+			in_slide = slide_nums == slide_num
+			windows = slide_num_to_windows.setdefault(slide_num, ([], [], []))
+			windows[0].append(xs[in_slide])
+			windows[1].append(ys[in_slide])
+			windows[2].append(probs[in_slide])
+
+			#write out a slide once all of its windows are in
+			if sum(len(batch_xs) for batch_xs in windows[0]) == slide_sizes[in_slide][0]:
+				slide_xs, slide_ys, slide_probs = [np.concatenate(column) for column in slide_num_to_windows.pop(slide_num)]
+				if config.prediction_format == 'npz':
+					write_predictions(output_folder, slides[slide_num], slide_xs, slide_ys, slide_probs)
+				else:
+					write_predictions_csv(output_folder, slides[slide_num], slide_xs, slide_ys, slide_probs)
+				print("predicted", len(slide_xs), 'windows of', slides[slide_num])
+				counts['slides'] += 1
+				counts['windows'] += len(slide_xs)
+
+	dataloader = torch.utils.data.DataLoader(image_dataset, batch_size=config.batch_size, shuffle=False, **get_dataloader_kwargs(persistent_workers=False))
+
+	with torch.no_grad():
+		for batch in dataloader:
+			test_inputs, slide_nums, xs, ys, slide_sizes = batch[:5]
+
+			if cache is None:
+				test_outputs = model(test_inputs.to(device))
+				probs = nn.Softmax(dim=1)(test_outputs).float().cpu().numpy()
+			else:
+				#stored windows come with the digest of their bytes from the workers, windows cut from slides are keyed by their input tensor
+				digests = batch[5] if len(batch) > 5 else [content_digest(test_input.numpy().tobytes()) for test_input in test_inputs]
+				keys_batch = [cache.key(model_digest, digest) for digest in digests]
+				key_to_probs = cache.get_many(keys_batch)
+				probs = np.zeros((len(keys_batch), config.num_classes), dtype=np.float32)
+				missing = [i for i, key in enumerate(keys_batch) if key not in key_to_probs]
+				for i, key in enumerate(keys_batch):
+					if key in key_to_probs:
+						probs[i] = key_to_probs[key]
+				if len(missing) > 0:
+					test_outputs = model(test_inputs[missing].to(device))
+					probs[missing] = nn.Softmax(dim=1)(test_outputs).float().cpu().numpy()
+					cache.put_many([keys_batch[i] for i in missing], probs[missing])
+				counts['cached'] += len(keys_batch) - len(missing)
+
+			add_windows(slide_nums.numpy(), xs.numpy(), ys.numpy(), slide_sizes.numpy(), probs)
+
+	if cache is not None:
+		print(counts['cached'], 'of', counts['windows'], 'window predictions came from the cache')
+	return counts['slides'], counts['windows']
+
 #main function for running on all the generated windows
-def get_predictions(patches_eval_folder, auto_select, eval_model, checkpoints_folder, output_folder):
+#if wsi_folder is given, windows are cut straight from its slides and patches_eval_folder is not read
+def get_predictions(patches_eval_folder, auto_select, eval_model, checkpoints_folder, output_folder, wsi_folder=None):
 
 	device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu") 
 
@@ -364,14 +754,10 @@ def get_predictions(patches_eval_folder, auto_select, eval_model, checkpoints_fo
 	else:
 		model_path = eval_model
 
-	model = torch.load(model_path)
+	model, _ = load_checkpoint(model_path, device)
 	model.train(False) 
 	print('model loaded from', model_path)
 
-	#for outputting the predictions
-	class_num_to_class = {i:config.classes[i] for i in range(len(config.classes))}
-	class_to_class_num = {v: k for k, v in class_num_to_class.items()}
-
 	#data transforms, no augmentation this time.
 	data_transforms = {
 		'normalize': transforms.Compose([
@@ -386,61 +772,38 @@ def get_predictions(patches_eval_folder, auto_select, eval_model, checkpoints_fo
 
 	start = time.time()
 
-	#load data for each folder:
-	image_folders = get_subfolder_paths(patches_eval_folder) 
-	
-	for image_folder in image_folders: #for each whole slide
-
-		#where we want to write out the predictions
-		confirm_output_folder(output_folder)
-		csv_path = join(output_folder, image_folder.split('/')[-1])+'.csv'
-		writer = open(csv_path, 'w')
-		writer.write("x,y,prediction,confidence\n")
-
-		#load the image dataset
-		image_dataset = datasets.ImageFolder(image_folder, data_transforms['normalize'])
-		dataloader = torch.utils.data.DataLoader(image_dataset, batch_size=config.batch_size, shuffle=False, num_workers=4)
-		num_test_image_windows = len(dataloader)*config.batch_size
-
-		#load the image names so we know the coordinates of the windows we are predicting
-		image_folder = join(image_folder, image_folder.split('/')[-1])
-		window_names = get_image_paths(image_folder) 
-
-		print("testing on", num_test_image_windows, 'crops from', image_folder)
-		batch_num = 0
-
-		#loop through all the windows
-		for test_inputs, test_labels in dataloader:
-
-			batch_window_names = window_names[batch_num*config.batch_size:batch_num*config.batch_size+config.batch_size]
-			test_inputs = test_inputs.to(device)
-			test_outputs = model(test_inputs)
-			softmax_test_outputs = nn.Softmax()(test_outputs)
-			confidences, test_preds = torch.max(softmax_test_outputs, 1)
-
-			for i in range(test_preds.shape[0]):
-				#unnormalized_image = data_transforms['unnormalize'](test_inputs[i]).cpu().numpy()
-				#unnormalized_image = np.swapaxes(unnormalized_image, 0, 2) #in case you want to make sure you're looking at the right image
-
-				#get coordinates and predicted class
-				image_name = batch_window_names[i]
-				x = basename(image_name).split('.')[0].split(';')[0]
-				y = basename(image_name).split('.')[0].split(';')[1]
-				predicted_class = class_num_to_class[test_preds[i].data.item()]
-				confidence = confidences[i].data.item()
-
-				#write them 
-				out_line = ','.join([x, y, predicted_class, str(confidence)[:5]]) + '\n'
-				writer.write(out_line)
-
-				#out_path = 'check_images_2/' + image_folder.split('/')[-1] + '_' + str(counter) + '_' + '_'.join([x, y, predicted_class, str(confidence)[:5]]) + '.jpg'
-				#imsave(out_path, unnormalized_image)
-
-			batch_num += 1
-
-		writer.close()
-
-	print('time for', patches_eval_folder, ':', time.time()-start, 'seconds')
+	#one stream of windows over all the slides, cut from the slides or read from patches on disk
+	if wsi_folder is not None:
+		slide_paths = get_all_image_paths(wsi_folder)
+		slides = [basename(slide_path).split('.')[0] for slide_path in slide_paths]
+		image_dataset = SlideStreamDataset(slide_paths, config.patch_size, config.slide_overlap, data_transforms['normalize'])
+	else:
+		if config.patch_store == 'shards':
+			slide_to_dataset = get_slide_datasets(patches_eval_folder, data_transforms['normalize'])
+			slide_datasets = [(slide, slide_to_dataset[slide], slide_to_dataset[slide].get_coordinates()) for slide in slide_to_dataset]
+		else:
+			slide_datasets = []
+			for image_folder in get_subfolder_paths(patches_eval_folder): #for each whole slide
+				window_coordinates = [tuple(int(c) for c in basename(image_name).split('.')[0].split(';')) for image_name in get_image_paths(join(image_folder, image_folder.split('/')[-1]))]
+				if len(window_coordinates) > 0:
+					slide_datasets.append((image_folder.split('/')[-1], datasets.ImageFolder(image_folder, data_transforms['normalize']), window_coordinates))
+		slides = [slide for slide, _, _ in slide_datasets]
+		if len(slides) == 0:
+			print('no windows found in', patches_eval_folder)
+			return
+		image_dataset = torch.utils.data.ConcatDataset([TaggedSlideDataset(dataset, slide_num, coordinates, config.use_prediction_cache) for slide_num, (_, dataset, coordinates) in enumerate(slide_datasets)])
+
+	#reuse the predictions of this checkpoint on windows it has already seen
+	cache, model_digest = None, None
+	if config.use_prediction_cache:
+		cache, model_digest = PredictionCache(config.prediction_cache, config.prediction_cache_mb), file_digest(model_path)
+
+	num_slides, num_windows = predict_slides(model, device, image_dataset, slides, output_folder, cache, model_digest)
+	if cache is not None:
+		cache.close()
+
+	total_time = max(time.time() - start, 1e-9)
+	print('{} slides and {} windows in {:.1f} seconds: {:.2f} slides/sec, {:.1f} windows/sec'.format(num_slides, num_windows, total_time, num_slides/total_time, num_windows/total_time))
 
 
 
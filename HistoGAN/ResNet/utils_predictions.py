@@ -0,0 +1,74 @@
+# DeepSlide
+# Jason Wei, Behnaz Abdollahi, Saeed Hassanpour
+
+# Reading and writing the window predictions of each whole slide.
+
+import config
+from utils import *
+
+###########################################
+######## WRITING SLIDE PREDICTIONS ########
+###########################################
+
+#write the predictions of one whole slide as a columnar npz file
+#coordinates are int32 (int16 would overflow on slides wider than 32767 pixels) and the full softmax is kept as float16
+def write_predictions(output_folder, slide, xs, ys, probs):
+	confirm_output_folder(output_folder)
+	probs = np.asarray(probs, dtype=np.float32).reshape(-1, config.num_classes)
+	np.savez(	join(output_folder, slide + '.npz'),
+				x=np.asarray(xs, dtype=np.int32),
+				y=np.asarray(ys, dtype=np.int32),
+				class_num=np.argmax(probs, axis=1).astype(np.uint8),
+				probs=probs.astype(np.float16),
+				classes=np.array(config.classes))
+
+#write the predictions of one whole slide in the old x,y,prediction,confidence csv format
+def write_predictions_csv(output_folder, slide, xs, ys, probs):
+	confirm_output_folder(output_folder)
+	probs = np.asarray(probs).reshape(-1, config.num_classes)
+	writer = open(join(output_folder, slide + '.csv'), 'w')
+	writer.write("x,y,prediction,confidence\n")
+	for x, y, window_probs in zip(xs, ys, probs):
+		class_num = int(np.argmax(window_probs))
+		writer.write(','.join([str(x).zfill(5), str(y).zfill(5), config.classes[class_num], str(float(window_probs[class_num]))[:5]]) + '\n')
+	writer.close()
+
+###########################################
+######## READING SLIDE PREDICTIONS ########
+###########################################
+
+#prediction files in a folder, one per slide. if a slide has both, the npz file is used
+def get_prediction_paths(folder):
+	slide_to_path = {}
+	for path in get_csv_paths(folder) + [join(folder, f) for f in listdir(folder) if f.endswith('.npz')]:
+		slide = file_no_extension(basename(path))
+		if slide not in slide_to_path or path.endswith('.npz'):
+			slide_to_path[slide] = path
+	return [slide_to_path[slide] for slide in sorted(slide_to_path)]
+
+#'slide.jpg' from 'preds_val/slide.npz' or 'preds_val/slide.csv', the name used in the label csvs
+def prediction_path_to_slide(path):
+	return file_no_extension(basename(path)) + '.jpg'
+
+#read the predictions of one whole slide from an npz or csv file
+#returns a dictionary of arrays: x, y, class_num, confidence, and probs (None for csv files, which only have the top class)
+def read_predictions(path):
+
+	if path.endswith('.npz'):
+		with np.load(path) as predictions:
+			probs = predictions['probs'].astype(np.float32)
+			class_num = predictions['class_num'].astype(np.int64)
+			return {'x': predictions['x'].astype(np.int64),
+					'y': predictions['y'].astype(np.int64),
+					'class_num': class_num,
+					'confidence': probs[np.arange(len(class_num)), class_num],
+					'probs': probs}
+
+	class_to_class_num = {_class: i for i, _class in enumerate(config.classes)}
+	lines = open(path, 'r').readlines()[1:]
+	line_items = [line[:-1].split(',') for line in lines if len(line) > 1]
+	return {'x': np.array([int(items[0]) for items in line_items], dtype=np.int64),
+			'y': np.array([int(items[1]) for items in line_items], dtype=np.int64),
+			'class_num': np.array([class_to_class_num.get(items[2], -1) for items in line_items], dtype=np.int64),
+			'confidence': np.array([float(items[3]) for items in line_items], dtype=np.float64),
+			'probs': None}
@@ -9,6 +9,8 @@ from utils import *
 from PIL import Image
 Image.MAX_IMAGE_PIXELS=1e10
 import cv2
+import multiprocessing
+from utils_shards import ShardWriter, encode_patch
 
 import skimage.measure
 from skimage.transform import rescale, rotate
@@ -25,21 +27,43 @@ def is_purple_dot(r, g, b):
 		return True
 	return False
 	
+#vectorized is_purple_dot over arrays of pooled r, g, b values
+def are_purple_dots(r, g, b):
+	rb_avg = (r+b)/2
+	return (r > g - 10) & (b > g - 10) & (rb_avg > g + 20)
+
 #this is actually a better method than is whitespace, but only if your images are purple lols
 def is_purple(crop):
 	pooled = skimage.measure.block_reduce(crop, (int(crop.shape[0]/15), int(crop.shape[1]/15), 1), np.average)
-	num_purple_squares = 0
-	for x in range(pooled.shape[0]):
-		for y in range(pooled.shape[1]):
-			r = pooled[x, y, 0]
-			g = pooled[x, y, 1]
-			b = pooled[x, y, 2]
-			if is_purple_dot(r, g, b):
-				num_purple_squares += 1
+	num_purple_squares = np.count_nonzero(are_purple_dots(pooled[:, :, 0], pooled[:, :, 1], pooled[:, :, 2]))
 	if num_purple_squares > 100: 
 		return True
 	return False
 
+#is_purple for every window of a whole image at once, returns a boolean array indexed by [x start, y start]
+#each row of windows is pooled once, and the block averages of every window are read off a running sum along y
+def is_purple_windows(image, x_starts, y_starts, window_size):
+
+	block = int(window_size/15)
+	if window_size % block != 0: #block_reduce would pad the edge blocks, so fall back to one window at a time
+		return np.array([[is_purple(image[x:x+window_size, y:y+window_size, :]) for y in y_starts] for x in x_starts], dtype=bool)
+
+	num_blocks = window_size // block
+	y_offsets = np.arange(num_blocks) * block
+	purple = np.zeros((len(x_starts), len(y_starts)), dtype=bool)
+	for i, x_start in enumerate(x_starts):
+		#sum each block row of the strip over x, then take a running sum along y
+		strip = image[x_start:x_start+window_size, :, :].astype(np.int64)
+		strip_sums = strip.reshape(num_blocks, block, image.shape[1], 3).sum(axis=1)
+		running = np.zeros((num_blocks, image.shape[1]+1, 3), dtype=np.int64)
+		np.cumsum(strip_sums, axis=1, out=running[:, 1:, :])
+		#block sums for every window in the strip, shape (num_blocks, num windows, num_blocks, 3)
+		block_starts = np.asarray(y_starts)[:, None] + y_offsets[None, :]
+		pooled = (running[:, block_starts+block, :] - running[:, block_starts, :]) / float(block*block)
+		num_purple_squares = np.count_nonzero(are_purple_dots(pooled[..., 0], pooled[..., 1], pooled[..., 2]), axis=(0, 2))
+		purple[i] = num_purple_squares > 100
+	return purple
+
 
 
 ###########################################
@@ -88,88 +112,165 @@ def zero_pad(image, patch_size):
 
 	return new_image #return the padded image
 
+#get the small windows of a single wsi, returns the number of windows written
+#if to_shards, nothing is written and a list of (x, y, encoded patch) is returned for a ShardWriter
+def produce_patches_from_image(image_path, output_subfolder, inverse_overlap_factor, to_shards=False):
+
+	image_name = basename(image_path)
+	image = cv2.imread(image_path)
+	image = zero_pad(image, config.patch_size) #zero pad if too small
+	outputed_windows = 0
+	encoded_windows = []
+
+	x_max = image.shape[0] #width of image
+	y_max = image.shape[1] #height of image
+	window_size = 224
+	x_steps = int((x_max-window_size) / window_size * inverse_overlap_factor) #number of x starting points
+	y_steps = int((y_max-window_size) / window_size * inverse_overlap_factor) #number of y starting points
+	step_size = int(config.patch_size / inverse_overlap_factor) #step size, same for x and y
+
+	#check every window for whitespace in one pass over the image
+	if config.type_histopath:
+		purple_windows = is_purple_windows(image, [i*step_size for i in range(x_steps+1)], [j*step_size for j in range(y_steps+1)], config.patch_size)
+
+	#loop through the entire big image
+	for i in range(x_steps+1):
+		for j in range(y_steps+1):
+
+			#get a patch
+			x_start = i*step_size
+			x_end = x_start + config.patch_size
+			y_start = j*step_size
+			y_end = y_start + config.patch_size
+			assert x_start >= 0; assert y_start >= 0; assert x_end <= x_max; assert y_end <= y_max
+			patch = image[x_start:x_end, y_start:y_end, :]
+			assert patch.shape == (config.patch_size, config.patch_size, 3)
+			out_path = join(output_subfolder, file_no_extension(image_name)+"_"+str(x_start)+"_"+str(y_start)+".jpg")
+
+			if config.type_histopath and not purple_windows[i, j]: #do you want to check for white space? only keep purple windows (histopathology images)
+				continue
+
+			if to_shards:
+				encoded_windows.append((x_start, y_start, encode_patch(patch)))
+			else:
+				imsave(out_path, patch)
+			outputed_windows += 1
+
+	if to_shards:
+		return encoded_windows
+	return outputed_windows
+
+#run a per wsi function over image paths, spread over a pool of processes if workers > 1
+#returns the list of results
+def map_slides(function, image_paths, *args, workers=1):
+	jobs = [(image_path,) + args for image_path in image_paths]
+	if workers > 1:
+		with multiprocessing.Pool(workers) as pool:
+			return pool.starmap(function, jobs, chunksize=1)
+	return [function(*job) for job in jobs]
+
+def call_job(job):
+	return job[0](*job[1:])
+
+#same as map_slides, but yields results in order as they finish so that they never all sit in memory
+def imap_slides(function, image_paths, *args, workers=1):
+	jobs = [(function, image_path) + args for image_path in image_paths]
+	if workers > 1:
+		with multiprocessing.Pool(workers) as pool:
+			for result in pool.imap(call_job, jobs, chunksize=1):
+				yield result
+	else:
+		for job in jobs:
+			yield call_job(job)
+
+#write the (x, y, encoded patch) windows of each wsi to a shard store as they are produced
+#returns the number of windows written
+def write_slides_to_shards(writer, function, image_paths, _class, *args, workers=1):
+	num_windows = 0
+	for image_path, encoded_windows in zip(image_paths, imap_slides(function, image_paths, *args, workers=workers)):
+		slide = file_no_extension(basename(image_path))
+		for x, y, encoded_patch in encoded_windows:
+			writer.write(encoded_patch, slide, str(x).zfill(5), str(y).zfill(5), _class)
+		num_windows += len(encoded_windows)
+	return num_windows
+
+#print how fast slides and patches were produced
+def print_throughput(num_slides, num_patches, total_time):
+	total_time = max(total_time, 1e-9)
+	print('{} slides and {} patches in {:.1f} seconds: {:.2f} slides/sec, {:.1f} patches/sec'.format(num_slides, num_patches, total_time, num_slides/total_time, num_patches/total_time))
+
 #get the small windows a given subfolder
 #this is a big boy function
-def produce_patches(input_subfolder, output_subfolder, inverse_overlap_factor):
+#if a shard writer is given, patches go into its shards labeled with the name of output_subfolder instead
+def produce_patches(input_subfolder, output_subfolder, inverse_overlap_factor, workers=1, writer=None):
 
-	confirm_output_folder(output_subfolder)#make the directory if it doens't exist
+	if writer is None:
+		confirm_output_folder(output_subfolder)#make the directory if it doens't exist
 	image_names = get_image_names(input_subfolder)
 	start_time = time.time()
-	outputed_windows_per_subfolder = 0
 
 	print('\n' + "getting small crops from " + str(len(image_names)) + ' images in ' + input_subfolder + " with inverse overlap factor " + str(inverse_overlap_factor) + " outputting in " + output_subfolder)
 
-	#get the patches for each wsi
-	for image_name in image_names:
-
-		image_path = join(input_subfolder, image_name)
-		image = cv2.imread(image_path)
-		image = zero_pad(image, config.patch_size) #zero pad if too small
-
-		x_max = image.shape[0] #width of image
-		y_max = image.shape[1] #height of image
-		window_size = 224
-		x_steps = int((x_max-window_size) / window_size * inverse_overlap_factor) #number of x starting points
-		y_steps = int((y_max-window_size) / window_size * inverse_overlap_factor) #number of y starting points
-		step_size = int(config.patch_size / inverse_overlap_factor) #step size, same for x and y
-
-		#loop through the entire big image
-		for i in range(x_steps+1):
-			for j in range(y_steps+1):
-
-				#get a patch
-				x_start = i*step_size
-				x_end = x_start + config.patch_size
-				y_start = j*step_size
-				y_end = y_start + config.patch_size
-				assert x_start >= 0; assert y_start >= 0; assert x_end <= x_max; assert y_end <= y_max
-				patch = image[x_start:x_end, y_start:y_end, :]
-				assert patch.shape == (config.patch_size, config.patch_size, 3)
-				out_path = join(output_subfolder, file_no_extension(image_name)+"_"+str(x_start)+"_"+str(y_start)+".jpg")
-
-				if config.type_histopath: #do you want to check for white space?
-					if is_purple(patch): #if its purple (histopathology images)
-						imsave(out_path, patch)
-						outputed_windows_per_subfolder += 1
-
-				else:
-					imsave(out_path, patch)
-					outputed_windows_per_subfolder += 1
+	#get the patches for each wsi, patch names start with the wsi name so workers never write the same file
+	image_paths = [join(input_subfolder, image_name) for image_name in image_names]
+	if writer is None:
+		outputed_windows_per_subfolder = sum(map_slides(produce_patches_from_image, image_paths, output_subfolder, inverse_overlap_factor, workers=workers))
+	else:
+		outputed_windows_per_subfolder = write_slides_to_shards(writer, produce_patches_from_image, image_paths, basename(output_subfolder), output_subfolder, inverse_overlap_factor, True, workers=workers)
 
 	total_time = time.time() - start_time
 	print("finished patches from " + input_subfolder + " with inverse overlap factor " + str(inverse_overlap_factor) + " outputting in " + output_subfolder)
 	print('total time : ', total_time, 'for', outputed_windows_per_subfolder, 'patches')
+	return len(image_paths), outputed_windows_per_subfolder
 
 #use this function to generate all patches for subfolders in the training set
-def gen_train_patches(input_folder, output_folder, num_train_per_class):
+def gen_train_patches(input_folder, output_folder, num_train_per_class, workers=1):
 
 	#get the subfolders and how much patches should overlap for each
 	subfolders = get_subfolder_paths(input_folder)
 	print(len(subfolders), "subfolders found from", input_folder)
 	subfolder_to_overlap_factor = get_subfolder_to_overlap(subfolders, num_train_per_class)
 	#print(subfolder_to_overlap_factor)
+	start_time = time.time()
+	num_slides, num_patches = 0, 0
+	writer = ShardWriter(output_folder) if config.patch_store == 'shards' else None
 
 	#produce the patches
 	for input_subfolder in subfolders:
 		overlap_factor = subfolder_to_overlap_factor[input_subfolder]
 		output_subfolder = join(output_folder, input_subfolder.split('/')[-1])
-		produce_patches(input_subfolder, output_subfolder, overlap_factor)
+		subfolder_slides, subfolder_patches = produce_patches(input_subfolder, output_subfolder, overlap_factor, workers, writer)
+		num_slides += subfolder_slides
+		num_patches += subfolder_patches
+
+	if writer is not None:
+		writer.close()
 
 	print("\nfinished all folders\n")
+	print_throughput(num_slides, num_patches, time.time() - start_time)
 
 #use this function to generate all patches for subfolders in the validation set
-def gen_val_patches(input_folder, output_folder, overlap_factor):
+def gen_val_patches(input_folder, output_folder, overlap_factor, workers=1):
 
 	#get the subfolders and how much patches should overlap for each
 	subfolders = get_subfolder_paths(input_folder)
 	print(len(subfolders), "subfolders found from", input_folder)
+	start_time = time.time()
+	num_slides, num_patches = 0, 0
+	writer = ShardWriter(output_folder) if config.patch_store == 'shards' else None
 
 	#produce the patches
 	for input_subfolder in subfolders:
 		output_subfolder = join(output_folder, input_subfolder.split('/')[-1])
-		produce_patches(input_subfolder, output_subfolder, overlap_factor)
+		subfolder_slides, subfolder_patches = produce_patches(input_subfolder, output_subfolder, overlap_factor, workers, writer)
+		num_slides += subfolder_slides
+		num_patches += subfolder_patches
+
+	if writer is not None:
+		writer.close()
 
 	print("\nfinished all folders\n")
+	print_throughput(num_slides, num_patches, time.time() - start_time)
 
 
 ###########################################
@@ -214,73 +315,82 @@ def add_zeros(string):
 		string = "0" + string
 	return string
 
+#starting coordinates of the sliding windows over an image of size x_max by y_max
+def get_window_starts(x_max, y_max, inverse_overlap_factor):
+	x_steps = int((x_max-config.patch_size) / config.patch_size * inverse_overlap_factor) #number of x starting points
+	y_steps = int((y_max-config.patch_size) / config.patch_size * inverse_overlap_factor) #number of y starting points
+	step_size = int(config.patch_size / inverse_overlap_factor) #step size, same for x and y
+	return [i*step_size for i in range(x_steps+1)], [j*step_size for j in range(y_steps+1)]
+
+#get the small windows of a single wsi into its own subfolder, returns the number of windows written
+#if to_shards, nothing is written and a list of (x, y, encoded patch) is returned for a ShardWriter
+def gen_patches_from_image(image_path, output_folder, inverse_overlap_factor, to_shards=False):
+
+	#load the image
+	image = cv2.imread(image_path)
+	x_max = image.shape[0] #width of image
+	y_max = image.shape[1] #height of image
+
+	if x_max < 224 or y_max < 224:
+		print(image_path, 'of size', x_max, 'by', y_max, "is too small")
+		return [] if to_shards else 0
+
+	num_outputed_windows = 0
+	encoded_windows = []
+	x_starts, y_starts = get_window_starts(x_max, y_max, inverse_overlap_factor)
+
+	#check every window for whitespace in one pass over the image
+	if config.type_histopath:
+		purple_windows = is_purple_windows(image, x_starts, y_starts, config.patch_size)
+
+	#this is hacky due to the way patches are loaded into pytorch
+	output_subsubfolder = join(output_folder, basename(image_path).split('.')[0])
+	output_subsubfolder = join(output_subsubfolder, output_subsubfolder.split('/')[-1])
+	if not to_shards:
+		confirm_output_folder(output_subsubfolder)
+
+	#slide the window
+	for i, x_start in enumerate(x_starts):
+		for j, y_start in enumerate(y_starts):
+
+			x_end = x_start + config.patch_size
+			y_end = y_start + config.patch_size
+			assert x_start >= 0; assert y_start >= 0; assert x_end <= x_max; assert y_end <= y_max
+
+			patch = image[x_start:x_end, y_start:y_end, :]
+			assert patch.shape == (config.patch_size, config.patch_size, 3)
+			out_path = join(output_subsubfolder, add_zeros(str(x_start))+";"+add_zeros(str(y_start))+".jpg")
+
+			if config.type_histopath and not purple_windows[i, j]: #do you want to check for white space? only keep purple windows (histopathology images)
+				continue
+
+			if to_shards:
+				encoded_windows.append((x_start, y_start, encode_patch(patch)))
+			else:
+				imsave(out_path, patch)
+			num_outputed_windows += 1
+
+	print(image_path, ": num outputed windows:", num_outputed_windows)#, "; percent whitespace:", str(whitespace_ratio)[:6])
+	if to_shards:
+		return encoded_windows
+	return num_outputed_windows
+
 #big boy function
-def gen_patches_by_folder(input_folder, output_folder, inverse_overlap_factor):
+def gen_patches_by_folder(input_folder, output_folder, inverse_overlap_factor, workers=1):
 	
 	start_time = time.time()
 	print('\n' + "getting small crops from " + input_folder + " with inverse overlap factor " + str(inverse_overlap_factor) + " outputting in " + output_folder)
 	confirm_output_folder(output_folder)
 	image_paths = get_all_image_paths(input_folder)
 
-	#for each wsi...
-	for image_path in image_paths:
-
-		#load the image
-		image = cv2.imread(image_path)
-		x_max = image.shape[0] #width of image
-		y_max = image.shape[1] #height of image
-
-		if x_max < 224 or y_max < 224:
-			print(image_path, 'of size', x_max, 'by', y_max, "is too small")
-
-		else:
-			num_outputed_windows = 0
-			x_steps = int((x_max-config.patch_size) / config.patch_size * inverse_overlap_factor) #number of x starting points
-			y_steps = int((y_max-config.patch_size) / config.patch_size * inverse_overlap_factor) #number of y starting points
-			step_size = int(config.patch_size / inverse_overlap_factor) #step size, same for x and y
-
-			#this is hacky due to the way patches are loaded into pytorch
-			output_subsubfolder = join(output_folder, basename(image_path).split('.')[0])
-			output_subsubfolder = join(output_subsubfolder, output_subsubfolder.split('/')[-1])
-			confirm_output_folder(output_subsubfolder)
-
-			#slide the window
-			for i in range(x_steps+1):
-				for j in range(y_steps+1):
-
-					x_start = i*step_size
-					x_end = x_start + config.patch_size
-					y_start = j*step_size
-					y_end = y_start + config.patch_size
-					assert x_start >= 0; assert y_start >= 0; assert x_end <= x_max; assert y_end <= y_max
-
-					patch = image[x_start:x_end, y_start:y_end, :]
-					assert patch.shape == (config.patch_size, config.patch_size, 3)
-					out_path = join(output_subsubfolder, add_zeros(str(x_start))+";"+add_zeros(str(y_start))+".jpg")
-
-					if config.type_histopath: #do you want to check for white space?
-						if is_purple(patch): #if its purple (histopathology images)
-							imsave(out_path, patch)
-							num_outputed_windows += 1
-					else:
-						imsave(out_path, patch)
-						num_outputed_windows += 1
-
-			print(image_path, ": num outputed windows:", num_outputed_windows)#, "; percent whitespace:", str(whitespace_ratio)[:6])
-			
+	#for each wsi, each writing to its own subfolder, or all into one shard store
+	if config.patch_store == 'shards':
+		writer = ShardWriter(output_folder)
+		num_patches = write_slides_to_shards(writer, gen_patches_from_image, image_paths, '', output_folder, inverse_overlap_factor, True, workers=workers)
+		writer.close()
+	else:
+		num_patches = sum(map_slides(gen_patches_from_image, image_paths, output_folder, inverse_overlap_factor, workers=workers))
 
 	total_time = time.time() - start_time
 	print("finished generating patches from " + input_folder + " in " + str(total_time) + " seconds " + " outputting in " + output_folder)
-
-
-
-
-
-
-
-
-
-
-
-
-
+	print_throughput(len(image_paths), num_patches, total_time)
@@ -0,0 +1,154 @@
+# DeepSlide
+# Jason Wei, Behnaz Abdollahi, Saeed Hassanpour
+
+# Packing patches into large sequential shard files instead of one jpeg per window.
+
+import config
+from utils import *
+
+import io
+import struct
+import random
+import cv2
+from PIL import Image
+
+import torch
+
+###########################################
+############# WRITING SHARDS ##############
+###########################################
+
+#each record in a shard is a 4 byte little endian length followed by the jpeg bytes
+record_header = struct.Struct('<I')
+index_header = 'shard,offset,length,slide,x,y,class\n'
+
+#encode a patch the same way scipy.misc.imsave wrote it, so that pixels match the jpeg backend
+#(patches come from cv2.imread in bgr order and were saved as if they were rgb)
+def encode_patch(patch):
+	success, encoded = cv2.imencode('.jpg', np.ascontiguousarray(patch[:, :, ::-1]), [cv2.IMWRITE_JPEG_QUALITY, 95])
+	assert success
+	return encoded.tobytes()
+
+#writes patches to numbered shard files in a folder, with one index.csv describing every record
+#each writer replaces the shards of an earlier run, so that rerunning never duplicates patches
+#the index is written to a temporary file and only replaces index.csv on close, so a crash never leaves a partial index
+class ShardWriter():
+	def __init__(self, folder, shard_size_mb=config.shard_size_mb):
+		confirm_output_folder(folder)
+		self.folder = folder
+		self.shard_size = int(shard_size_mb * 1000 * 1000)
+		for f in listdir(folder):
+			if (f.startswith('shard_') and f.endswith('.bin')) or f in ['index.csv', 'index.csv.tmp']:
+				os.remove(join(folder, f))
+		self.shard_num = 0
+		self.shard = None
+		self.index = open(join(folder, 'index.csv.tmp'), 'w')
+		self.index.write(index_header)
+
+	def _next_shard(self):
+		if self.shard is not None:
+			self.shard.close()
+		self.shard_name = 'shard_' + str(self.shard_num).zfill(5) + '.bin'
+		self.shard = open(join(self.folder, self.shard_name), 'wb')
+		self.shard_num += 1
+
+	def write(self, encoded_patch, slide, x, y, _class):
+		if self.shard is None or self.shard.tell() >= self.shard_size:
+			self._next_shard()
+		offset = self.shard.tell()
+		self.shard.write(record_header.pack(len(encoded_patch)))
+		self.shard.write(encoded_patch)
+		self.index.write(','.join([self.shard_name, str(offset + record_header.size), str(len(encoded_patch)), slide, str(x), str(y), _class]) + '\n')
+
+	def close(self):
+		if self.shard is not None:
+			self.shard.close()
+		self.index.close()
+		os.replace(join(self.folder, 'index.csv.tmp'), join(self.folder, 'index.csv'))
+
+###########################################
+############# READING SHARDS ##############
+###########################################
+
+#read the index of a shard folder into a list of (shard, offset, length, slide, x, y, class) tuples
+def read_shard_index(folder):
+	records = []
+	lines = open(join(folder, 'index.csv'), 'r').readlines()[1:]
+	for line in lines:
+		shard, offset, length, slide, x, y, _class = line[:-1].split(',')
+		records.append((shard, int(offset), int(length), slide, int(x), int(y), _class))
+	return records
+
+#drop-in replacement for datasets.ImageFolder over a shard folder, returns (image, class number) pairs
+class ShardDataset(torch.utils.data.Dataset):
+	def __init__(self, folder, transform=None, classes=None, records=None):
+		self.folder = folder
+		self.transform = transform
+		self.records = records if records is not None else read_shard_index(folder)
+		#keep records in file order so that reads are sequential
+		self.records = sorted(self.records, key=lambda record: (record[0], record[1]))
+		self.classes = classes if classes is not None else sorted(set(record[6] for record in self.records))
+		self.class_to_idx = {_class: i for i, _class in enumerate(self.classes)}
+		unknown_classes = sorted(set(record[6] for record in self.records) - set(self.class_to_idx))
+		if unknown_classes:
+			raise ValueError('classes ' + str(unknown_classes) + ' in ' + folder + ' are not in ' + str(list(self.classes)))
+		self.targets = [self.class_to_idx[record[6]] for record in self.records]
+		self.files = {}
+		self.pid = None
+
+	def __len__(self):
+		return len(self.records)
+
+	def _open(self, shard):
+		#file handles must not be shared between dataloader worker processes
+		if self.pid != os.getpid():
+			self.files = {}
+			self.pid = os.getpid()
+		if shard not in self.files:
+			self.files[shard] = open(join(self.folder, shard), 'rb')
+		return self.files[shard]
+
+	#the stored jpeg bytes of a window, before any decoding
+	def read_bytes(self, idx):
+		shard, offset, length = self.records[idx][:3]
+		f = self._open(shard)
+		f.seek(offset)
+		return f.read(length)
+
+	def __getitem__(self, idx):
+		image = Image.open(io.BytesIO(self.read_bytes(idx))).convert('RGB')
+		if self.transform is not None:
+			image = self.transform(image)
+		return image, self.targets[idx]
+
+	#x and y coordinates of every window, in dataset order
+	def get_coordinates(self):
+		return [(record[4], record[5]) for record in self.records]
+
+#one dataset per wsi of a shard folder, reading the index only once
+#returns a dictionary from slide name to dataset
+def get_slide_datasets(folder, transform=None):
+	slide_to_records = {}
+	for record in read_shard_index(folder):
+		slide_to_records.setdefault(record[3], []).append(record)
+	return {slide: ShardDataset(folder, transform, records=slide_to_records[slide]) for slide in sorted(slide_to_records)}
+
+#shuffles the order of shards and the records within each shard, so that each shard is still read as a block
+class ShardShuffleSampler(torch.utils.data.Sampler):
+	def __init__(self, dataset):
+		self.shard_to_indices = {}
+		for idx, record in enumerate(dataset.records):
+			self.shard_to_indices.setdefault(record[0], []).append(idx)
+		self.num_samples = len(dataset)
+
+	def __iter__(self):
+		shards = list(self.shard_to_indices.keys())
+		random.shuffle(shards)
+		for shard in shards:
+			indices = list(self.shard_to_indices[shard])
+			random.shuffle(indices)
+			for idx in indices:
+				yield idx
+
+	def __len__(self):
+		return self.num_samples
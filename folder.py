@@ -1,43 +1,103 @@
-import shutil, os
+import argparse
+import fcntl
+import os
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 
-labels = pd.read_csv("weed-gan/labels/labels.csv")
-labels = labels.sort_values('Species')
+FICLONE = 0x40049409  # ioctl to share the extents of a file on btrfs/xfs
 
-class_names = list(labels.Species.unique())
 
-train_images = '/images'
-train_cat = '/train_'
-for i in class_names:
-	os.makedirs(os.path.join('train_', i))
+def copy_atomic(src, dst):
+    # Copy through a temporary file, so an interrupted copy never leaves a partial image that a rerun would skip
+    shutil.copy(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
 
-for c in class_names: # Category Name
-	for i in list(labels[labels['Species']==c]['Filename']): # Image Id
-		get_image = os.path.join('images', i) # Path to Images
-		move_image_to_cat = shutil.copy(get_image, 'train_/'+c)
 
+def reflink_or_copy(src, dst):
+    # Clone the file where the filesystem supports it, otherwise fall back to a regular copy
+    try:
+        with open(src, 'rb') as s, open(dst + '.tmp', 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        os.replace(dst + '.tmp', dst)
+    except OSError:
+        copy_atomic(src, dst)
 
-for c in class_names:
 
-    train_path = os.path.join('set' ,c , 'train/')
-    test_path  = os.path.join('set', c , 'test/')
+def place(src, dst, mode):
+    if os.path.exists(dst):
+        return False # already placed by a previous run
+    if os.path.lexists(dst):
+        os.remove(dst) # a symlink whose image has gone
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+        except OSError:
+            copy_atomic(src, dst) # the output is on another filesystem
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src), dst)
+    elif mode == 'reflink':
+        reflink_or_copy(src, dst)
+    else:
+        copy_atomic(src, dst)
+    return True
 
-    in_path    = os.path.join('train_' , c)
 
-    os.makedirs(train_path , exist_ok=True)
+def remove_unassigned(path, filenames):
+    # Remove what an earlier run with another seed or test ratio left here, so no image is in both train and test
+    removed = 0
+    for filename in os.listdir(path):
+        if filename not in filenames:
+            os.remove(os.path.join(path, filename))
+            removed += 1
+    return removed
+
+
+def materialize_class(species, filenames, image_directory, output_directory, test_ratio, seed, mode):
+    # Deterministic split: sort, then shuffle with a per class seed
+    filenames = sorted(filenames)
+    random.Random('{}-{}'.format(seed, species)).shuffle(filenames)
+    test_set = int(len(filenames) * test_ratio)
+
+    train_path = os.path.join(output_directory, species, 'train')
+    test_path = os.path.join(output_directory, species, 'test')
+    os.makedirs(train_path, exist_ok=True)
     os.makedirs(test_path, exist_ok=True)
 
-    filenames = os.listdir(in_path)
+    placed = 0
+    for i, filename in enumerate(filenames):
+        out_path = test_path if i < test_set else train_path
+        placed += place(os.path.join(image_directory, filename), os.path.join(out_path, filename), mode)
+    removed = remove_unassigned(test_path, set(filenames[:test_set])) + \
+        remove_unassigned(train_path, set(filenames[test_set:]))
+    return species, test_set, len(filenames) - test_set, placed, removed
+
+
+def materialize(labels_csv, image_directory, output_directory, test_ratio, seed, mode, workers):
+    labels = pd.read_csv(labels_csv)
+    class_to_filenames = labels.groupby('Species').Filename.apply(list).to_dict()
 
-    no_of_pictures = len(filenames)
+    # Each class is written by its own worker in a single pass over labels.csv
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(materialize_class, species, filenames, image_directory, output_directory,
+                                   test_ratio, seed, mode) for species, filenames in class_to_filenames.items()]
+        for future in futures:
+            species, num_test, num_train, placed, removed = future.result()
+            print('{}: #train={} #test={} ({} new files, {} stale files removed)'.format(
+                species, num_train, num_test, placed, removed))
 
-    test_set = int(len(filenames) * 0.3)
-    train_set= len(filenames) - test_set
 
-    test_imgs = filenames[:test_set]
-    train_imgs = filenames[test_set:]
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Materialize per class train/test folders of DeepWeeds images.')
+    parser.add_argument('--labels', default='weed-gan/labels/labels.csv', help='labels csv with Filename and Species')
+    parser.add_argument('--images', default='images', help='folder holding the images')
+    parser.add_argument('--output', default='set', help='output folder, laid out as <species>/train and <species>/test')
+    parser.add_argument('--test-ratio', type=float, default=0.3, help='fraction of each class used for testing')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the train/test split')
+    parser.add_argument('--mode', default='hardlink', choices=['hardlink', 'symlink', 'reflink', 'copy'],
+                        help='how images are placed in the output folders')
+    parser.add_argument('--workers', type=int, default=8, help='number of classes materialized in parallel')
+    args = parser.parse_args()
 
-    for test_img in test_imgs:
-        shutil.move( in_path + '/'  + test_img, test_path + test_img)
-    for train_img in train_imgs:
-        shutil.move( in_path + '/' + train_img, train_path + train_img)
\ No newline at end of file
+    materialize(args.labels, args.images, args.output, args.test_ratio, args.seed, args.mode, args.workers)